@@ -1,4 +1,7 @@
 from fdimagelib.floppy_image import *
+from fdimagelib.layout_cache import *
+from fdimagelib.image_diff import *
+from fdimagelib.flat_image import *
 from fdimagelib.fbasic_utils import *
 from fdimagelib.file_system import *
 from fdimagelib.ascii_j import *
@@ -1,16 +1,136 @@
+import copy
+import fnmatch
+import contextlib
+import collections.abc
+
 from fdimagelib.floppy_image import *
 from fdimagelib.ascii_j import *
 from fdimagelib.misc import *
 
+class DIRECTORY_ENTRY(collections.abc.MutableMapping):
+    """
+    A directory entry of F-BASIC file system. The FAT chain, num_sectors and file_name_j are resolved on the first access and memoized,
+    so listing the directory and looking up a file by name don't touch the FAT.  
+    Dict-style access (entry['file_name'], entry['num_sectors'], keys(), items(), ...) is available for compatibility.
+    """
+    __slots__ = ('file_name', 'file_type', 'ascii_flag', 'random_access_flag', 'top_cluster', 'dir_idx', '_file_name_j', '_num_sectors', '_chain', '_fs', '_image')
+    fields = ('file_name', 'file_name_j', 'file_type', 'ascii_flag', 'random_access_flag', 'top_cluster', 'num_sectors', 'dir_idx')
+
+    def __init__(self, fs, dir_idx, file_name, file_type, ascii_flag, random_access_flag, top_cluster, num_sectors=None, file_name_j=None):
+        self.dir_idx = dir_idx
+        self.file_name = file_name
+        self.file_type = file_type
+        self.ascii_flag = ascii_flag
+        self.random_access_flag = random_access_flag
+        self.top_cluster = top_cluster
+        self._file_name_j = file_name_j
+        self._num_sectors = num_sectors
+        self._chain = None
+        self._fs = fs
+        self._image = fs.image if fs is not None else None
+
+    @property
+    def file_name_j(self):
+        if self._file_name_j is None:
+            self._file_name_j = asciij_to_utf8(self.file_name)
+        return self._file_name_j
+
+    @file_name_j.setter
+    def file_name_j(self, value):
+        self._file_name_j = value
+
+    def get_chain(self):
+        """
+        Return:
+          (FAT chain, number of used sectors in the last cluster) of the file
+        """
+        if self._chain is None:
+            if self._fs is None:
+                raise ValueError('The directory entry is not bound to a file system')
+            if self.top_cluster >= 0 and self.top_cluster <= self._fs.max_cluster_num:
+                fs = self._fs
+                if fs.image is not self._image:     # The file system object has been switched to another disk image
+                    fs = copy.copy(fs)
+                    fs.set_image(self._image)
+                self._chain = fs.trace_FAT_chain(self.top_cluster)
+            else:
+                self._chain = ([], 0)
+        return self._chain
+
+    @property
+    def num_sectors(self):
+        if self._num_sectors is None:
+            if self.top_cluster >= 0 and self.top_cluster <= self._fs.max_cluster_num:
+                FAT_chain, last_secs = self.get_chain()
+                self._num_sectors = (len(FAT_chain)-1) * self._fs.sect_per_cluster + last_secs
+            else:
+                self._num_sectors = 0
+        return self._num_sectors
+
+    @num_sectors.setter
+    def num_sectors(self, value):
+        self._num_sectors = value
+
+    def __getitem__(self, key):
+        if key not in DIRECTORY_ENTRY.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in DIRECTORY_ENTRY.fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        raise TypeError('Directory entry parameters can\'t be deleted')
+
+    def __iter__(self):
+        return iter(DIRECTORY_ENTRY.fields)
+
+    def __len__(self):
+        return len(DIRECTORY_ENTRY.fields)
+
+    def __contains__(self, key):
+        return key in DIRECTORY_ENTRY.fields
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __reduce__(self):
+        # Resolved values only. The file system and the disk image are not sent to other processes.
+        return (DIRECTORY_ENTRY, (None, self.dir_idx, self.file_name, self.file_type, self.ascii_flag, self.random_access_flag, self.top_cluster,
+                                  self.num_sectors, self.file_name_j))
+
+    def copy(self):
+        """
+        Return a copy of the entry. The resolved values are copied, and the unresolved ones are resolved separately.
+        """
+        entry = DIRECTORY_ENTRY.__new__(DIRECTORY_ENTRY)
+        for slot in DIRECTORY_ENTRY.__slots__:
+            setattr(entry, slot, getattr(self, slot))
+        return entry
+
+    __copy__ = copy
+
+    def to_dict(self):
+        return { key:getattr(self, key) for key in DIRECTORY_ENTRY.fields }
+
+
 class FM_FILE_SYSTEM:
     def __init__(self):
         self.sect_per_cluster = 8
         self.sect_per_track = 16
+        self.bytes_per_sector = 256
         self.max_cluster_num = 151
         self.image = None
+        self.discard_FAT()
+        self.discard_directory()
+        self._op_depth = 0
 
     def set_image(self, image:FLOPPY_DISK_D88):
         self.image = image
+        self.discard_FAT()
+        self.discard_directory()
 
     def check_disk_id(self):
         id_sect = self.image.read_sector(0, (0, 0, 3))
@@ -59,11 +179,134 @@ class FM_FILE_SYSTEM:
 
 
     def read_FAT(self):
-        FAT = self.image.read_sector(2, (1, 0, 1))['sect_data']
-        return bytearray(FAT)
+        """
+        Return a copy of the FAT. Modifying the returned data doesn't affect the disk image until it is written by write_FAT().
+        """
+        return bytearray(self._read_FAT())
+
+    def _read_FAT(self):
+        """
+        Return the cached FAT itself. The FAT sector is read again only when the FAT track has been modified since it was cached
+        (written by others, rolled back, etc), which the track version of the disk image tells. Modify the FAT through write_FAT() or set_FAT_entry().
+        """
+        if not self.FAT_dirty:
+            FAT_version = self.image.get_track_version(2)
+            if FAT_version != self.FAT_version:
+                self.FAT = bytearray(self.image.read_sector(2, (1, 0, 1))['sect_data'])
+                self.FAT_version = FAT_version
+                self.build_free_map()
+        return self.FAT
 
     def write_FAT(self, FAT_data):
-        self.image.write_sector(2, (1, 0, 1), FAT_data)
+        """
+        Write the FAT. The FAT sector is written immediately, except in a high-level operation (write_file, delete_file, ...)
+        where the FAT sector is written back once by flush() at the end of the operation.
+        """
+        self.FAT = bytearray(FAT_data)
+        self.FAT_dirty = True
+        self.build_free_map()
+        self.discard_directory()                            # The number of sectors of the files may be changed
+        if self._op_depth == 0:
+            self.flush()
+
+    def set_FAT_entry(self, cluster, value):
+        """
+        Update an entry of the cached FAT, and the free cluster map along with it.
+        """
+        FAT = self._read_FAT()
+        was_free = FAT[cluster + 5] == 0xff
+        FAT[cluster + 5] = value
+        if was_free != (value == 0xff):
+            self.free_map[cluster] = not was_free
+            self.num_free_clusters += 1 if not was_free else -1
+        self.FAT_dirty = True
+
+    def build_free_map(self):
+        """
+        Build the free cluster map (free_map[cluster] = True when the cluster is free) from the cached FAT.
+        """
+        self.free_map = [ self.FAT[cluster + 5] == 0xff for cluster in range(self.max_cluster_num + 1) ]
+        self.num_free_clusters = sum(self.free_map)
+
+    def find_free_runs(self):
+        """
+        Return:
+          List of (top cluster, number of clusters) of the contiguous free clusters
+        """
+        self._read_FAT()
+        runs = []
+        top = -1
+        for cluster, free in enumerate(self.free_map + [ False ]):
+            if free and top == -1:
+                top = cluster
+            elif not free and top != -1:
+                runs.append((top, cluster - top))
+                top = -1
+        return runs
+
+    def allocate_clusters(self, num_clusters):
+        """
+        Choose free clusters for a file. The smallest contiguous free run which fits the file is chosen (best fit).
+        When no run fits, the largest runs are used first to keep the number of fragments small.
+        The FAT is not modified.  
+        Return:
+          List of cluster numbers in the chain order. An empty list when there are not enough free clusters.
+        """
+        if num_clusters > self.get_number_of_free_clusters():
+            return []
+        runs = self.find_free_runs()
+        fits = [ run for run in runs if run[1] >= num_clusters ]
+        if len(fits) > 0:
+            top, length = min(fits, key=lambda run: (run[1], run[0]))
+            return list(range(top, top + num_clusters))
+        chain = []
+        for top, length in sorted(runs, key=lambda run: (-run[1], run[0])):
+            chain.extend(range(top, top + min(length, num_clusters - len(chain))))
+            if len(chain) == num_clusters:
+                break
+        return chain
+
+    def flush(self):
+        """
+        Write the cached FAT back to the disk image if it is modified.
+        """
+        if not self.FAT_dirty:
+            return
+        dir_cached = self.is_directory_cached()
+        self.image.write_sector(2, (1, 0, 1), self.FAT)
+        self.FAT_version = self.image.get_track_version(2)
+        self.FAT_dirty = False
+        if dir_cached:
+            self.dir_versions = self.get_directory_versions()  # The cached directory entries already reflect the FAT
+
+    def discard_FAT(self):
+        """
+        Drop the cached FAT including the changes which are not written back yet.
+        """
+        self.FAT = None
+        self.FAT_version = None
+        self.FAT_dirty = False
+        self.free_map = None
+        self.num_free_clusters = 0
+
+    @contextlib.contextmanager
+    def operation(self):
+        """
+        Run a high-level operation in a transaction of the disk image. The cached FAT is written back once at the end of the outermost operation,
+        or discarded together with the other changes when an exception is raised.
+        """
+        with self.image.transaction():
+            self._op_depth += 1
+            try:
+                yield self
+                if self._op_depth == 1:
+                    self.flush()
+            except BaseException:
+                self.discard_FAT()
+                self.discard_directory()
+                raise
+            finally:
+                self._op_depth -= 1
 
     def trace_FAT_chain(self, start_cluster):
         """
@@ -71,9 +314,11 @@ class FM_FILE_SYSTEM:
           start_cluster
         """
         chain = []
-        FAT = self.read_FAT()
+        FAT = self._read_FAT()
         curr_cluster = start_cluster
         while True:
+            if len(chain) > self.max_cluster_num:
+                return ([], -1)                                 # Broken FAT (looped chain)
             chain.append(curr_cluster)
             next_cluster = FAT[5 + curr_cluster]                # FAT starts from 6th byte
             if next_cluster <= 0x97:   # 0x97 == 151 == self.max_cluster_num
@@ -90,39 +335,68 @@ class FM_FILE_SYSTEM:
                 return ([], -1)                                 # This cluster is free (not used)
 
     def delete_FAT_chain(self, chain:list[int]):
-        FAT = bytearray(self.read_FAT())
         for ch in chain[0]:
             if ch <= self.max_cluster_num:
-                FAT[ch + 5] = 0xff
-        self.write_FAT(FAT)
+                self.set_FAT_entry(ch, 0xff)
 
     def find_empty_cluster(self):
         """
         Return:
           An empty cluster number. -1 when no empty cluster is found.
         """
-        FAT = self.read_FAT()
-        for cluster in range(self.max_cluster_num + 1):
-            if FAT[cluster + 5] == 0xff:
-                return cluster
-        return -1
+        self._read_FAT()
+        if self.num_free_clusters == 0:
+            return -1
+        return self.free_map.index(True)
 
     def get_number_of_free_clusters(self):
-        FAT = self.read_FAT()
-        count = 0
-        ofst = 5
-        for pos in range(self.max_cluster_num+1):
-            if FAT[pos + ofst] == 0xff:
-                count += 1
-        return count
+        self._read_FAT()
+        return self.num_free_clusters
 
-    def get_all_directory_entries(self):
+    def get_directory_versions(self):
+        return tuple([ self.image.get_track_version(track) for track in (2, 3) ])     # FAT and directory (LBA 32-63)
+
+    def is_directory_cached(self):
+        return self.dir_entries is not None and self.dir_versions == self.get_directory_versions()
+
+    def discard_directory(self):
+        """
+        Drop the cached directory entries.
+        """
+        self.dir_entries = None                 # All directory entries in the order of dir_idx
+        self.dir_valid_entries = None
+        self.dir_index = None                   # { normalized file name: valid directory entry }
+        self.dir_versions = None
+
+    def decode_directory_entry(self, dir_idx, sect_data, idx):
         """
         Return:
-          [{'file_name':, 'file_name_j':, 'file_type':, 
-          'ascii_flag':, 'random_access_flag':, 
-          'top_cluster':, 'num_sectors':, 'dir_idx': }]
+          DIRECTORY_ENTRY. The FAT chain and num_sectors are resolved on the first access.
+        """
+        file_name, file_type, ascii_flag, random_access_flag, top_cluster = struct.unpack_from('<8s3xBBBB', sect_data, idx * 32)
+        return DIRECTORY_ENTRY(self, dir_idx, file_name, file_type, ascii_flag, random_access_flag, top_cluster)
+
+    def is_valid_directory_entry(self, dir_entry):
+        if dir_entry['file_name'][0] == 0x00:        # Deleted entry
+            return False
+        if dir_entry['file_name'][0] == 0xff:
+            return False                # ever used ?
+        if dir_entry['file_type'] not in (0, 1, 2) or dir_entry['ascii_flag'] not in (0, 0xff) or dir_entry['random_access_flag'] not in (0, 0xff) or dir_entry['top_cluster'] > self.max_cluster_num:
+            return False
+        return True
+
+    def build_directory_index(self):
+        self.dir_valid_entries = [ dir_entry for dir_entry in self.dir_entries if self.is_valid_directory_entry(dir_entry) ]
+        self.dir_index = {}
+        for dir_entry in self.dir_valid_entries:
+            self.dir_index.setdefault(bytes(self.normalize_file_name(dir_entry['file_name'])), dir_entry)   # The first one wins as the linear search did
+
+    def load_directory(self):
         """
+        Decode all directory entries and cache them. The cache is used until the FAT or the directory tracks are modified by others.
+        """
+        if self.is_directory_cached():
+            return
         files = []
         directory_start_sector = self.CHR_to_LBA(1, 0, 4)
         dir_idx = 0
@@ -132,19 +406,21 @@ class FM_FILE_SYSTEM:
             sect_data = data['sect_data']
             # 1 directory entry = 32 bytes
             for idx in range(256//32):
-                entry = struct.unpack_from('<8s3xBBBB', sect_data, idx * 32)
-                file_name, file_type, ascii_flag, random_access_flag, top_cluster = entry
-                file_name_j = asciij_to_utf8(file_name)
-                if top_cluster >=0 and top_cluster <= self.max_cluster_num:
-                    FAT_chain, last_secs = self.trace_FAT_chain(top_cluster)
-                    num_sectors = (len(FAT_chain)-1) * self.sect_per_cluster + last_secs
-                else:
-                    FAT_chain, last_secs = [], 0
-                    num_sectors = 0
-                res = { 'file_name':file_name, 'file_name_j':file_name_j, 'file_type':file_type, 'ascii_flag':ascii_flag, 'random_access_flag':random_access_flag, 'top_cluster':top_cluster, 'num_sectors':num_sectors, 'dir_idx':dir_idx }
-                files.append(res)
+                files.append(self.decode_directory_entry(dir_idx, sect_data, idx))
                 dir_idx += 1
-        return files
+        self.dir_entries = files
+        self.build_directory_index()
+        self.dir_versions = self.get_directory_versions()
+
+    def get_all_directory_entries(self):
+        """
+        Return:
+          [{'file_name':, 'file_name_j':, 'file_type':, 
+          'ascii_flag':, 'random_access_flag':, 
+          'top_cluster':, 'num_sectors':, 'dir_idx': }]
+        """
+        self.load_directory()
+        return [ dir_entry.copy() for dir_entry in self.dir_entries ]
 
     def get_valid_directory_entries(self):
         """
@@ -153,17 +429,16 @@ class FM_FILE_SYSTEM:
           'ascii_flag':, 'random_access_flag':, 
           'top_cluster':, 'num_sectors':, 'dir_idx': }]
         """
-        valid_entries = []
-        dir_entries = self.get_all_directory_entries()
-        for dir_entry in dir_entries:
-            if dir_entry['file_name'][0] == 0x00:        # Deleted entry
-                continue
-            if dir_entry['file_name'][0] == 0xff:
-                continue                    # ever used ?
-            if dir_entry['file_type'] not in (0, 1, 2) or dir_entry['ascii_flag'] not in (0, 0xff) or dir_entry['random_access_flag'] not in (0, 0xff) or dir_entry['top_cluster'] > self.max_cluster_num:
-                continue
-            valid_entries.append(dir_entry)
-        return valid_entries
+        self.load_directory()
+        return [ dir_entry.copy() for dir_entry in self.dir_valid_entries ]
+
+    def lookup_directory_entry(self, file_name:str):
+        """
+        Return:
+          The cached DIRECTORY_ENTRY of a file (not a copy). None when the file is not found.
+        """
+        self.load_directory()
+        return self.dir_index.get(bytes(self.normalize_file_name(file_name)))
 
     def get_directory_entry(self, file_name:str):
         """
@@ -172,11 +447,9 @@ class FM_FILE_SYSTEM:
           'ascii_flag':, 'random_access_flag':, 
           'top_cluster':, 'num_sectors':, 'dir_idx': }
         """
-        dir_entries = self.get_valid_directory_entries()
-        for dir_entry in dir_entries:
-            match = self.compare_file_names(dir_entry['file_name'], file_name)
-            if match:
-                return dir_entry
+        dir_entry = self.lookup_directory_entry(file_name)
+        if dir_entry is not None:
+            return dir_entry.copy()
         return {'file_name':'', 'file_name_j':'', 'file_type':-1, 'ascii_flag':-1, 'random_access_flag':-1, 'top_cluster':-1, 'num_sectors=':-1, 'dir_idx':-1}
 
 
@@ -207,16 +480,9 @@ class FM_FILE_SYSTEM:
     def get_directory_entry_idx(self, file_name:str):
         """
         Return:
-          The index of directory entry (starts with 0). -1 when there was no empty directory entry.
+          The index of directory entry (starts with 0). -1 when the file is not found.
         """
-        dir_entries = self.get_valid_directory_entries()
-        #file_name_j = bytearray(asciij_string_to_utf8(file_name).encode())
-        for dir_entry in dir_entries:
-            for ofst in range(0, 256, 32):
-                match = self.compare_file_names(dir_entry['file_name'], file_name)
-                if match:
-                    return dir_entry['dir_idx']
-        return -1
+        return self.get_directory_entry(file_name)['dir_idx']
 
     def find_empty_directory_slot(self):
         """
@@ -248,7 +514,13 @@ class FM_FILE_SYSTEM:
 
     def write_directry_by_dir_idx(self, dir_idx, data):
         sect = dir_idx // (256//32)     # 8 directory entries per sector
-        data = self.image.write_sector_LBA(self.sect_per_track * 2 + 3 + sect, data)
+        dir_cached = self.is_directory_cached()
+        self.image.write_sector_LBA(self.sect_per_track * 2 + 3 + sect, data)
+        if dir_cached and sect < len(self.dir_entries) // (256//32):
+            for idx in range(256//32):          # Update the cached entries in the sector instead of decoding the whole directory again
+                self.dir_entries[sect * (256//32) + idx] = self.decode_directory_entry(sect * (256//32) + idx, data, idx)
+            self.build_directory_index()
+            self.dir_versions = self.get_directory_versions()
 
     def create_directory_entry(self, file_name:bytearray, file_type:int, ascii_flag:int, random_access_flag:int, top_cluster:int):
         dir_idx = self.find_empty_directory_slot()
@@ -277,15 +549,17 @@ class FM_FILE_SYSTEM:
         chain: list of cluster numbers
         last_secs: number of sectors used in the last cluster
         """
-        res = bytearray()
-        if len(chain)>0:
-            num_secs = [ self.sect_per_cluster for _ in range(len(chain)-1) ]
+        if len(chain) == 0:
+            return bytearray()
+        num_secs = [ self.sect_per_cluster for _ in range(len(chain)-1) ]
         num_secs.append(last_secs)
+        res = bytearray(sum(num_secs) * self.bytes_per_sector)
+        buffer = memoryview(res)
+        pos = 0
         for cluster, num_sec in zip(chain, num_secs):
-            LBA = self.cluster_to_LBA(cluster)
-            for ofst in range(num_sec):
-                sect_data = self.image.read_sector_LBA(LBA + ofst)['sect_data']
-                res.extend(sect_data)
+            pos += self.image.readinto_sectors_LBA(self.cluster_to_LBA(cluster), num_sec, buffer[pos:])
+        buffer.release()
+        del res[pos:]
         return res
 
     def validate_file_attributes(self, file_type, ascii_flag, random_access_flag):
@@ -310,10 +584,11 @@ class FM_FILE_SYSTEM:
         file_name = self.normalize_file_name(file_name)
         if self.is_exist(file_name) == False:
             raise FileNotFoundError
-        dir_entry = self.get_directory_entry(file_name)
-        fat_chain = self.trace_FAT_chain(dir_entry['top_cluster'])
-        self.delete_FAT_chain(fat_chain)
-        self.delete_directory_entry(dir_entry['dir_idx'])
+        with self.operation():
+            dir_entry = self.get_directory_entry(file_name)
+            fat_chain = self.trace_FAT_chain(dir_entry['top_cluster'])
+            self.delete_FAT_chain(fat_chain)
+            self.delete_directory_entry(dir_entry['dir_idx'])
 
     def read_file(self, file_name:str):
         """
@@ -321,13 +596,30 @@ class FM_FILE_SYSTEM:
           Dict { 'data', 'file_type', 'ascii_flag', 'file_name', 'file_name_j', 'random_access_flag, 'top_cluster', 'num_sectors', 'dir_idx' }
         """
         file_name = self.normalize_file_name(file_name)
-        dir_entry = self.get_directory_entry(file_name)
-        assert dir_entry['file_name'] != ''                     # File not found
-        chain, last_secs = self.trace_FAT_chain(dir_entry['top_cluster'])
+        dir_entry = self.lookup_directory_entry(file_name)
+        assert dir_entry is not None                            # File not found
+        chain, last_secs = dir_entry.get_chain()                # Memoized in the cached directory entry
         file_data = self.read_cluster_chain(chain, last_secs)
         res = { 'data':file_data, **dir_entry }
         return res
 
+    def extract_all(self, pattern:str=None):
+        """
+        Read all valid files at once. The directory and the FAT are decoded once, and the cluster chains are read in the order of their location on the disk.  
+            Input parameters:  
+            pattern = File name pattern. '*' and '?' can be used as wildcards, and it is not case sensitive. None reads all files.  
+        Return:
+          List of dicts same as read_file() in the order of dir_idx
+        """
+        self.load_directory()
+        dir_entries = [ dir_entry for dir_entry in self.dir_valid_entries
+                        if pattern is None or fnmatch.fnmatchcase(dir_entry.file_name_j.rstrip().upper(), pattern.upper()) ]
+        files = {}
+        for dir_entry in sorted(dir_entries, key=lambda dir_entry: dir_entry.top_cluster):
+            chain, last_secs = dir_entry.get_chain()
+            files[dir_entry.dir_idx] = { 'data':self.read_cluster_chain(chain, last_secs), **dir_entry }
+        return [ files[dir_entry.dir_idx] for dir_entry in dir_entries ]
+
     def read_file_by_idx(self, dir_idx:int):
         """
         Read file using directory index number to specify the file.
@@ -341,44 +633,37 @@ class FM_FILE_SYSTEM:
         return res
 
     def write_file(self, file_name:str, write_data:bytearray, file_type:int, ascii_flag:int, random_access_flag:int, overwrite=False):
+        """
+        Write a file. The disk image is rolled back when the write fails (disk full, etc).
+        """
         if self.validate_file_name(file_name) == False:
             raise ValueError
         if self.validate_file_attributes(file_type, ascii_flag, random_access_flag) == False:
             raise ValueError
         file_name = self.normalize_file_name(file_name)
-        if self.is_exist(file_name):
-            if overwrite:
-                self.delete_file(file_name)
-            else:
-                raise FileExistsError
-        write_data = self.pad_data_to_fit_sector(write_data)
-        FAT = self.read_FAT()
-        top_cluster = -1
-        prev_cluster = -1
-        while True:
+        with self.operation():
+            if self.is_exist(file_name):
+                if overwrite:
+                    self.delete_file(file_name)
+                else:
+                    raise FileExistsError
+            write_data = self.pad_data_to_fit_sector(write_data)
             assert len(write_data) % 256 == 0
-            self.write_FAT(FAT)                                 # Write back FAT before searching for an empty cluster
-            current_cluster = self.find_empty_cluster()
-            assert current_cluster != -1                        # Disk full
-            if top_cluster == -1:
-                top_cluster = current_cluster                   # Memorize the top cluster nunber
-            if prev_cluster != -1:
-                assert prev_cluster != current_cluster
-                FAT[prev_cluster + 5] = current_cluster
-            LBA = self.cluster_to_LBA(current_cluster)
-            for sect_count in range(self.sect_per_cluster):
-                self.image.write_sector_LBA(LBA + sect_count, write_data[:256])
-                write_data = write_data[256:]
-                FAT[current_cluster + 5] = 0xc0 + sect_count
-                if len(write_data) == 0:
-                    break
-            if sect_count < self.sect_per_cluster - 1:
-                break
-            prev_cluster = current_cluster
-            if len(write_data) == 0:
-                return
-        self.write_FAT(FAT)
-        self.create_directory_entry(file_name, file_type, ascii_flag, random_access_flag, top_cluster)
+            num_sectors = len(write_data) // 256
+            num_clusters = (num_sectors + self.sect_per_cluster - 1) // self.sect_per_cluster
+            chain = self.allocate_clusters(num_clusters)            # The whole chain is allocated up front
+            assert len(chain) == num_clusters                       # Disk full
+            data = memoryview(write_data)
+            for chain_idx, cluster in enumerate(chain):
+                LBA = self.cluster_to_LBA(cluster)
+                top_sect = chain_idx * self.sect_per_cluster
+                num_secs = min(self.sect_per_cluster, num_sectors - top_sect)
+                for sect_count in range(num_secs):
+                    pos = (top_sect + sect_count) * 256
+                    self.image.write_sector_LBA(LBA + sect_count, data[pos : pos + 256])
+                next_cluster = chain[chain_idx + 1] if chain_idx + 1 < len(chain) else 0xc0 + num_secs - 1
+                self.set_FAT_entry(cluster, next_cluster)
+            self.create_directory_entry(file_name, file_type, ascii_flag, random_access_flag, chain[0])
 
 
 
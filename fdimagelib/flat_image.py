@@ -0,0 +1,248 @@
+import os
+import mmap
+import contextlib
+
+from fdimagelib.floppy_image import *
+
+class FLAT_DISK_IMAGE:
+    """
+    Raw sector image (.2d, .img, etc). The sectors are stored in the order of LBA without any headers, so LBA is turned into the file offset directly.  
+    This class has the same sector access interface as FLOPPY_DISK_D88 (read_sector, read_sector_LBA, write_sector, write_sector_LBA, etc),  
+    and FM_FILE_SYSTEM works on it as well.
+    """
+    def __init__(self, num_tracks=80, sect_per_track=16, sect_size=256):
+        """
+            Input parameters:  
+            num_tracks = Number of tracks (2D: 80 = 40 cylinders * 2 heads)  
+            sect_per_track = Number of sectors in a track  
+            sect_size = Sector size in bytes
+        """
+        self.num_tracks = num_tracks
+        self.sect_per_track = sect_per_track
+        self.sect_size = sect_size
+        self.image_data = bytearray(num_tracks * sect_per_track * sect_size)
+        self.file_name = None
+        self._transactions = []
+        self._write_count = 0
+        self.invalidate_track_versions()
+
+    def get_num_sectors(self) -> int:
+        return self.num_tracks * self.sect_per_track
+
+    def read_file(self, file_name, use_mmap=False):
+        """
+        Read a raw sector image file. The number of tracks is determined by the file size.  
+            Input parameters:  
+            file_name = Raw sector image file name  
+            use_mmap = Map the file to the memory instead of reading it. The modifications are kept in the memory (copy-on-write) until write_file() is called.
+        """
+        if not os.path.isfile(file_name):
+            raise FileNotFoundError
+        track_size = self.sect_per_track * self.sect_size
+        file_size = os.path.getsize(file_name)
+        if file_size == 0 or file_size % track_size != 0:
+            raise ValueError(f'The file size is not a multiple of the track size ({file_size}, {track_size})')
+        with open(file_name, 'rb') as f:
+            if use_mmap:
+                self.image_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            else:
+                self.image_data = bytearray(f.read())
+        self.num_tracks = file_size // track_size
+        self.file_name = file_name
+        self.invalidate_track_versions()
+
+    def write_file(self, file_name):
+        """
+        Write the image to a raw sector image file. The file is written through a temporary file.
+        """
+        if type(self.image_data) == mmap.mmap:
+            self.image_data = bytearray(self.image_data)        # Release the mapped file which may be replaced
+        write_file_atomically(file_name, lambda f: f.write(self.image_data))
+        self.file_name = file_name
+
+    def get_track_version(self, track) -> int:
+        """
+        Return a number which changes whenever the track is modified (same as FLOPPY_DISK_D88.get_track_version()).
+        """
+        return self._track_versions.get(track, self._base_version)
+
+    def invalidate_track_versions(self):
+        self._write_count += 1
+        self._base_version = self._write_count
+        self._track_versions = {}
+
+    def LBA_to_track_sect(self, LBA):
+        return LBA // self.sect_per_track, LBA % self.sect_per_track
+
+    def get_sector_offset(self, LBA) -> int:
+        if LBA < 0 or LBA >= self.get_num_sectors():
+            raise ValueError(f'LBA out of range ({LBA})')
+        return LBA * self.sect_size
+
+    def read_sector_LBA(self, LBA):
+        """
+        Read a sector. Use LBA to specify the sector. LBA starts from 0 and LBA=0 represents the CHR=(0,0,1).  
+        The sector data is a read-only view of the image data.
+        """
+        if LBA < 0 or LBA >= self.get_num_sectors():
+            return None
+        ofst = LBA * self.sect_size
+        track, sect = self.LBA_to_track_sect(LBA)
+        N = self.sect_size.bit_length() - 8
+        return D88_SECTOR(sect, track // 2, track % 2, sect + 1, N, self.sect_per_track, 0x00, 0x00, 0x00, self.sect_size,
+                          memoryview(self.image_data)[ofst : ofst + self.sect_size].toreadonly())
+
+    def read_sector(self, track, sect_id, ignoreCH = True):
+        """
+        Read a sector. Use track number and sector ID (C, H, R) to specify the sector.
+        """
+        if track < 0 or track >= self.num_tracks:
+            raise ValueError
+        C, H, R = sect_id
+        if R < 1 or R > self.sect_per_track:
+            return None
+        if not ignoreCH and (C, H) != (track // 2, track % 2):
+            return None
+        return self.read_sector_LBA(track * self.sect_per_track + R - 1)
+
+    def read_sectors_LBA(self, start, count) -> memoryview:
+        """
+        Read contiguous sectors specified by LBA. The sectors are contiguous in the image data, so a read-only view is returned without copying.
+        """
+        ofst = self.get_sector_offset(start)
+        self.get_sector_offset(start + count - 1)
+        return memoryview(self.image_data)[ofst : ofst + count * self.sect_size].toreadonly()
+
+    def readinto_sectors_LBA(self, start, count, buffer) -> int:
+        size = count * self.sect_size
+        if size > len(buffer):
+            raise ValueError('Buffer is too small')
+        memoryview(buffer)[:size] = self.read_sectors_LBA(start, count)
+        return size
+
+    def write_sectors_LBA(self, start, write_data):
+        """
+        Write contiguous sectors specified by LBA at once. The data size must be a multiple of the sector size.
+        """
+        if len(write_data) % self.sect_size != 0:
+            raise ValueError(f'Data size must be a multiple of the sector size ({len(write_data)})')
+        count = len(write_data) // self.sect_size
+        ofst = self.get_sector_offset(start)
+        self.get_sector_offset(start + count - 1)
+        if len(self._transactions) > 0:
+            for LBA in range(start, start + count):
+                if LBA not in self._transactions[-1]:
+                    sect_ofst = LBA * self.sect_size
+                    self._transactions[-1][LBA] = bytes(self.image_data[sect_ofst : sect_ofst + self.sect_size])
+        self.image_data[ofst : ofst + len(write_data)] = write_data
+        self._write_count += 1
+        for track in range(start // self.sect_per_track, (start + count - 1) // self.sect_per_track + 1):
+            self._track_versions[track] = self._write_count
+
+    def write_sector_LBA(self, LBA, write_data=None, density=0x00, data_mark=0x00, status=0x00, create_new=False):
+        """
+        Write data to a sector. Use LBA to specify the sector. Short data is padded with 0x00.  
+        density, data_mark, status and create_new are accepted for the compatibility with FLOPPY_DISK_D88 and ignored.
+        """
+        if len(write_data) > self.sect_size:
+            raise ValueError(f'Data is larger than the sector size ({len(write_data)})')
+        if len(write_data) < self.sect_size:
+            write_data = bytes(write_data) + bytes(self.sect_size - len(write_data))
+        self.write_sectors_LBA(LBA, write_data)
+
+    def write_sector(self, track, sect_id = None, write_data=None, density=0x00, data_mark=0x00, status=0x00, ignoreCH = True, create_new=False):
+        """
+        Write data to a sector. Use track number and sector ID (C, H, R) to specify the sector.
+        """
+        if track < 0 or track >= self.num_tracks:
+            raise ValueError
+        C, H, R = sect_id
+        if R < 1 or R > self.sect_per_track or (not ignoreCH and (C, H) != (track // 2, track % 2)):
+            return                                  # Sector not found. A raw image can't have extra sectors.
+        self.write_sector_LBA(track * self.sect_per_track + R - 1, write_data)
+
+    def snapshot(self):
+        clone = FLAT_DISK_IMAGE(0, self.sect_per_track, self.sect_size)
+        clone.num_tracks = self.num_tracks
+        clone.image_data = bytearray(self.image_data)
+        return clone
+
+    def begin(self):
+        """
+        Start a transaction. The original data of the sectors written in the transaction are kept for rollback(). Transactions can be nested.
+        """
+        self._transactions.append({})
+
+    def commit(self):
+        if len(self._transactions) == 0:
+            raise ValueError('No transaction')
+        undo = self._transactions.pop()
+        if len(self._transactions) > 0:
+            for LBA, data in undo.items():
+                self._transactions[-1].setdefault(LBA, data)
+
+    def rollback(self):
+        if len(self._transactions) == 0:
+            raise ValueError('No transaction')
+        undo = self._transactions.pop()
+        for LBA, data in undo.items():
+            ofst = LBA * self.sect_size
+            self.image_data[ofst : ofst + self.sect_size] = data
+        self.invalidate_track_versions()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def to_d88(self) -> FLOPPY_DISK_D88:
+        """
+        Convert to a FLOPPY_DISK_D88 object. A whole track is copied at a time.
+        """
+        disk = FLOPPY_DISK_D88()
+        disk.set_meta_data(b'', 0x00, 0x00)
+        disk.sect_per_track = self.sect_per_track
+        N = self.sect_size.bit_length() - 8
+        track_size = self.sect_per_track * self.sect_size
+        tracks = []
+        for track in range(self.num_tracks):
+            track_data = bytes(self.image_data[track * track_size : (track + 1) * track_size])
+            track_view = memoryview(track_data)
+            tracks.append([ D88_SECTOR(sect, track // 2, track % 2, sect + 1, N, self.sect_per_track, 0x00, 0x00, 0x00, self.sect_size,
+                                       track_view[sect * self.sect_size : (sect + 1) * self.sect_size]) for sect in range(self.sect_per_track) ])
+        tracks.extend([ [] for _ in range(disk.d88_max_track - len(tracks)) ])
+        disk.tracks = tracks
+        return disk
+
+    def from_d88(self, disk:FLOPPY_DISK_D88, num_tracks=None):
+        """
+        Convert a FLOPPY_DISK_D88 object into this raw sector image. The sectors are placed in the order of the sector ID (R) and a whole track is copied at a time.  
+        The missing sectors are filled with 0x00.  
+            Input parameters:  
+            disk = Source disk image. The sector size must be the same as self.sect_size.  
+            num_tracks = Number of tracks to convert (None: up to the last track which has sectors)
+        """
+        if num_tracks is None:
+            num_tracks = max([ track + 1 for track, track_data in enumerate(disk.tracks) if len(track_data) > 0 ], default=0)
+        track_size = self.sect_per_track * self.sect_size
+        image_data = bytearray(num_tracks * track_size)
+        for track in range(num_tracks):
+            track_data = disk.tracks[track] if track < len(disk.tracks) else []
+            sectors = [ None ] * self.sect_per_track
+            for sect in track_data:
+                if 1 <= sect['R'] <= self.sect_per_track and sectors[sect['R'] - 1] is None:
+                    if len(sect['sect_data']) != self.sect_size:
+                        raise ValueError(f'Sector size mismatch (track {track}, R={sect["R"]}, {len(sect["sect_data"])})')
+                    sectors[sect['R'] - 1] = sect['sect_data']
+            if None in sectors:
+                sectors = [ bytes(self.sect_size) if data is None else data for data in sectors ]
+            image_data[track * track_size : (track + 1) * track_size] = b''.join(sectors)
+        self.image_data = image_data
+        self.num_tracks = num_tracks
+        self._transactions = []
+        self.invalidate_track_versions()
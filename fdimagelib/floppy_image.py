@@ -1,28 +1,573 @@
 import os
+import mmap
 import struct
-import math
+import functools
+import collections.abc
+import contextlib
+import warnings
+import concurrent.futures
 
+import zlib
+import gzip
+import lzma
+import bz2
+import zipfile
 import base64
 import yaml
 import json
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None                                # Windows. The journaled writes are not locked against the other processes.
+
+try:
+    from yaml import CSafeLoader as YAML_LOADER, CSafeDumper as YAML_DUMPER       # libyaml binding
+except ImportError:
+    from yaml import SafeLoader as YAML_LOADER, SafeDumper as YAML_DUMPER
+
+class LRU_BUDGET:
+    """
+    Upper limit of the number of items loaded by LAZY_LISTs. The least recently used items are unloaded when the limit is exceeded,
+    and they are loaded again by the loader on the next access. An item stays loaded while its LAZY_LIST refuses to unload it (pinned).
+    """
+    def __init__(self, max_items:int):
+        if max_items < 1:
+            raise ValueError(f'max_items must be 1 or larger ({max_items})')
+        self.max_items = max_items
+        self._loaded = collections.OrderedDict()        # (id(lazy list), idx): lazy list. The least recently used item first.
+
+    def __len__(self):
+        return len(self._loaded)
+
+    def touch(self, lazy_list, idx):
+        key = (id(lazy_list), idx)
+        if key in self._loaded:
+            self._loaded.move_to_end(key)
+
+    def add(self, lazy_list, idx):
+        key = (id(lazy_list), idx)
+        self._loaded[key] = lazy_list
+        self._loaded.move_to_end(key)
+        self.evict(keep=key)
+
+    def discard(self, lazy_list, idx):
+        self._loaded.pop((id(lazy_list), idx), None)
+
+    def evict(self, keep=None):
+        num_excess = len(self._loaded) - self.max_items
+        if num_excess <= 0:
+            return
+        victims = []
+        pinned = []
+        for key, lazy_list in self._loaded.items():
+            if len(victims) >= num_excess:
+                break
+            if key != keep:
+                (victims if lazy_list.unload(key[1]) else pinned).append(key)
+        for key in victims:
+            del self._loaded[key]
+        for key in pinned:
+            self._loaded.move_to_end(key)               # Don't check the pinned items again on every load
+
+
+class LAZY_LIST(collections.abc.MutableSequence):
+    """
+    List-like container whose items are generated by loader(key) on the first access.  
+    Each item slot keeps its key until it is loaded, so inserting or deleting items doesn't change the key of the other items.  
+    With an LRU_BUDGET, the loaded items are unloaded in the least recently used order and loaded again on the next access.
+    An item replaced by assignment is kept until release_replaced() or set_loader() is called, and on_unload(idx) can refuse to unload an item by returning False (e.g. a modified track).
+    """
+    class NOT_LOADED:
+        __slots__ = ('key',)
+        def __init__(self, key):
+            self.key = key
+
+    def __init__(self, keys, loader, budget:LRU_BUDGET=None, on_unload=None):
+        self._items = [ LAZY_LIST.NOT_LOADED(key) for key in keys ]
+        self._loader = loader
+        self._budget = budget
+        self._on_unload = on_unload
+        self._loaded_keys = {}                          # idx: key of the loaded items which can be unloaded
+        self._replaced_keys = {}                        # idx: key of the items replaced by assignment
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self._items)))]
+        item = self._items[idx]
+        if type(item) is LAZY_LIST.NOT_LOADED:
+            key = item.key
+            item = self._loader(key)
+            self._items[idx] = item
+            if self._budget is not None:
+                idx %= len(self._items)
+                self._loaded_keys[idx] = key
+                self._budget.add(self, idx)
+        elif self._budget is not None:
+            self._budget.touch(self, idx % len(self._items))
+        return item
+
+    def __setitem__(self, idx, item):
+        if self._budget is not None:
+            idx %= len(self._items)
+            old_item = self._items[idx]
+            if type(old_item) is LAZY_LIST.NOT_LOADED:
+                self._replaced_keys[idx] = old_item.key
+            elif idx in self._loaded_keys:
+                self._replaced_keys[idx] = self._loaded_keys.pop(idx)   # The new item can't be loaded again by the loader
+            self._budget.discard(self, idx)
+        self._items[idx] = item
+
+    def __delitem__(self, idx):
+        self.set_budget(None)                           # The indices are shifted. Keep all the loaded items from now on.
+        del self._items[idx]
+
+    def insert(self, idx, item):
+        self.set_budget(None)
+        self._items.insert(idx, item)
+
+    def __iter__(self):
+        for idx in range(len(self._items)):
+            yield self[idx]
+
+    def copy(self):
+        return list(self)
+
+    def is_loaded(self, idx):
+        return type(self._items[idx]) is not LAZY_LIST.NOT_LOADED
+
+    def get_key(self, idx):
+        """
+        Return the loader key of an item which is not loaded yet (None when the item is loaded).
+        """
+        item = self._items[idx]
+        return item.key if type(item) is LAZY_LIST.NOT_LOADED else None
+
+    def set_budget(self, budget:LRU_BUDGET):
+        """
+        Change the LRU_BUDGET. The loaded items are not unloaded by the old budget anymore. None keeps all the loaded items.
+        """
+        if self._budget is not None:
+            for idx in self._loaded_keys:
+                self._budget.discard(self, idx)
+        self._loaded_keys = {}
+        self._replaced_keys = {}
+        self._budget = budget
+
+    def release_replaced(self):
+        """
+        Let the budget unload the items replaced by assignment. Call this when the loader gives the same items as the current ones (e.g. they have been written to the source in place).
+        """
+        if self._budget is None:
+            return
+        replaced_keys = self._replaced_keys
+        self._replaced_keys = {}
+        for idx, key in replaced_keys.items():
+            self._loaded_keys[idx] = key
+            self._budget.add(self, idx)
+
+    def set_loader(self, loader, keys, budget:LRU_BUDGET=None):
+        """
+        Change the loader and the keys of all the item slots. Call this when the source of the items has been rewritten with the current items.  
+        All the loaded items, including the ones replaced by assignment, can be unloaded by the new budget from now on.
+        """
+        self.set_budget(None)
+        self._loader = loader
+        self._budget = budget
+        for idx, key in enumerate(keys):
+            if type(self._items[idx]) is LAZY_LIST.NOT_LOADED:
+                self._items[idx] = LAZY_LIST.NOT_LOADED(key)
+            elif budget is not None:
+                self._loaded_keys[idx] = key
+                budget.add(self, idx)
+
+    def unload(self, idx) -> bool:
+        """
+        Drop a loaded item. It is loaded again by the loader on the next access.  
+        Return:
+          False if the item can't be unloaded (replaced by assignment, or refused by on_unload)
+        """
+        if idx not in self._loaded_keys or (self._on_unload is not None and not self._on_unload(idx)):
+            return False
+        self._items[idx] = LAZY_LIST.NOT_LOADED(self._loaded_keys.pop(idx))
+        return True
+
+
+class D88_SECTOR(collections.abc.MutableMapping):
+    """
+    A sector in a D88 image. The sector keeps its parameters in slots instead of a dict to save memory.  
+    Dict-style access (sect['R'], sect['sect_data'], keys(), items(), ...) is available for compatibility.
+    """
+    __slots__ = ('sect_idx', 'C', 'H', 'R', 'N', 'num_sectors', 'density', 'data_mark', 'status', 'data_size', 'sect_data')
+
+    def __init__(self, sect_idx, C, H, R, N, num_sectors, density, data_mark, status, data_size, sect_data):
+        self.sect_idx = sect_idx
+        self.C = C
+        self.H = H
+        self.R = R
+        self.N = N
+        self.num_sectors = num_sectors
+        self.density = density
+        self.data_mark = data_mark
+        self.status = status
+        self.data_size = data_size
+        self.sect_data = sect_data
+
+    def __getitem__(self, key):
+        if key not in D88_SECTOR.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in D88_SECTOR.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        raise TypeError('Sector parameters can\'t be deleted')
+
+    def __iter__(self):
+        return iter(D88_SECTOR.__slots__)
+
+    def __len__(self):
+        return len(D88_SECTOR.__slots__)
+
+    def __contains__(self, key):
+        return key in D88_SECTOR.__slots__
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def copy(self):
+        return D88_SECTOR(**self)
+
+    def to_dict(self):
+        return { key:getattr(self, key) for key in D88_SECTOR.__slots__ }
+
+
 class FLOPPY_IMAGE_D88:
+    journal_magic = b'D88JRNL1'
+
     def __init__(self):
         self.image_data = None
         self.images:FLOPPY_DISK_D88 = []
+        self.image_index = []
         self.d88_max_track = 164
+        self.zero_copy = False
+        self.lazy = False
+        self.file_name = None
+        self.source_size = 0
+        self.source_stat = None                 # (inode, size, mtime) of the image file when it was read or written
+        self.track_budget = None
 
-    def read_file(self, file_name):
+    def read_file(self, file_name, zero_copy=False, lazy=False, workers=1, cache=None, max_images=None, max_cached_tracks=None):
+        """
+        Read a D88 image file.  
+            Input parameters:  
+            file_name = D88/D77 image file name  
+            zero_copy = Sector data refers to the loaded image data through memoryview instead of copying it.  
+                        The sector data becomes read-only and it is replaced with a bytearray on the first write_sector/write_sector_idx.  
+            lazy = Memory-map the file and parse a track on the first access to FLOPPY_DISK_D88.tracks[n]. Implies zero_copy.  
+            workers = Parse all disk images up front with a process pool of this size when it's larger than 1 (None: number of CPUs).  
+            cache = LAYOUT_CACHE object. The disk images are built from the cached layout without scanning the image data, and the layout is stored to the cache on a miss.  
+            max_images = Stop reading after this number of disk images (compressed files, archive members and file objects only)  
+            max_cached_tracks = Upper limit of the number of parsed tracks kept in memory over all the disk images. Implies lazy.  
+                                The least recently used tracks are dropped and parsed again on the next access. Modified tracks are kept until they are written.  
+        file_name can also be a binary file object, a compressed file ('.gz', '.xz' or '.bz2') or a member of a zip archive ('library.zip!/game.d88').
+        They are decompressed and parsed in a streaming way. The image data of them is kept in memory, and write_file() doesn't update them in place.
+        """
+        self.track_budget = LRU_BUDGET(max_cached_tracks) if max_cached_tracks is not None else None
+        lazy = lazy or max_cached_tracks is not None
+        if hasattr(file_name, 'read'):
+            self.read_stream(file_name, zero_copy, lazy, max_images)
+            return
+        file_name = os.fspath(file_name)                    # pathlib.Path is accepted as well
+        if is_streamed_source(file_name):
+            with open_image_source(file_name) as f:
+                self.read_stream(f, zero_copy, lazy, max_images)
+            return
         if not os.path.isfile(file_name):
             raise FileNotFoundError
+        self.recover_journal(file_name)
         with open(file_name, 'rb') as f:
-            self.image_data = f.read()
+            stat = os.fstat(f.fileno())
+            if lazy and os.path.getsize(file_name) > 0:
+                self.image_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.image_data = f.read()
+        self.zero_copy = zero_copy or lazy
+        self.lazy = lazy
+        self.file_name = file_name
+        self.source_size = len(self.image_data)
+        self.source_stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        image_index = cache.load(file_name, stat) if cache is not None else None
+        if image_index is not None:
+            self.image_index = image_index
+            self.images = LAZY_LIST(self.image_index, self.parse_disk_image)
+        else:
+            self.parse_image()
+            if cache is not None:
+                for index_entry in self.image_index:
+                    index_entry['layout'] = self.scan_layout(index_entry)
+                cache.store(file_name, stat, self.image_index)
+        if workers is None or workers > 1:
+            self.load_all_images(workers)
+
+    def read_stream(self, f, zero_copy=False, lazy=False, max_images=None):
+        """
+        Read D88 disk images from a binary file object one by one, up to max_images.
+        """
+        chunks = []
+        num_images = 0
+        while max_images is None or num_images < max_images:
+            header = read_exact(f, 0x20)
+            if len(header) == 0:
+                break
+            disk_size = struct.unpack_from('<I', header, 0x1c)[0] if len(header) == 0x20 else 0
+            if disk_size < 0x20:
+                raise ValueError(f'Broken D88 header (image #{num_images})')
+            body = read_exact(f, disk_size - 0x20)
+            if len(body) != disk_size - 0x20:
+                raise ValueError(f'Truncated D88 image (image #{num_images})')
+            chunks.extend([header, body])
+            num_images += 1
+        self.image_data = b''.join(chunks)
+        self.zero_copy = zero_copy or lazy
+        self.lazy = lazy
+        self.file_name = None                   # Not a file to be updated in place
+        self.source_stat = None
+        self.source_size = len(self.image_data)
         self.parse_image()
 
+    def load_all_images(self, workers=1):
+        """
+        Parse all disk images which are not parsed yet.  
+        The disk images are parsed in parallel by a process pool when workers is larger than 1 (None: number of CPUs).  
+        The disk images parsed in the worker processes own their sector data (no zero-copy, no lazy track parsing).
+        """
+        if type(self.images) != LAZY_LIST:
+            return
+        pending = [ idx for idx in range(len(self.images)) if not self.images.is_loaded(idx) ]
+        if (workers is None or workers > 1) and len(pending) > 1 and self.file_name is not None:
+            index_entries = [ self.images.get_key(idx) for idx in pending ]
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                disk_images = executor.map(_parse_disk_image_worker, [self.file_name] * len(pending), index_entries)
+                for idx, disk_image in zip(pending, disk_images):
+                    self.images[idx] = disk_image
+        else:
+            for idx in pending:
+                self.images[idx]
+
     def write_file(self, file_name):
-        self.reconstruct_image()
-        with open(file_name, 'wb') as f:
-            f.write(self.image_data)
+        """
+        Write the image to a file.  
+        When the file is the one the image was read from and the layout of the tracks is unchanged, only the modified tracks are written in place through a journal.
+        Otherwise the image is written to a temporary file, which replaces the file after it is flushed to the storage. The file is never left half-written.  
+        The existing file is locked while it is written, and the file modified by others since it was read is always rewritten as a whole.
+        """
+        file_name = os.fspath(file_name)
+        in_place = self.file_name is not None and os.path.isfile(file_name) and os.path.samefile(file_name, self.file_name)
+        with contextlib.ExitStack() as stack:
+            if os.path.isfile(file_name):
+                f = stack.enter_context(open_locked_file(file_name, 'r+b' if in_place else 'rb'))       # Serializes the writers
+                if in_place and self.is_source_unchanged(os.fstat(f.fileno())):
+                    patches = self.get_dirty_patches()
+                    if patches is not None:
+                        self.write_patches(f, file_name, patches)
+                        return
+            lazy, track_budget = self.lazy, self.track_budget
+            if self.lazy and fcntl is None:
+                self.detach_image_data()        # A mapped file can't be replaced on Windows. The old mapping stays valid after the replace elsewhere.
+            journal_file_name = self.get_journal_file_name(file_name)
+            if os.path.exists(journal_file_name):
+                os.remove(journal_file_name)        # Stale journal for the old contents. Must not be replayed to the new file.
+            def write_images(f):
+                for image in self.images:
+                    image.write_image_data(f)
+            # The lock is kept until the file is replaced. Without fcntl (Windows) there is no lock, and an open file can't be replaced there.
+            stat = write_file_atomically(file_name, write_images, before_replace=stack.close if fcntl is None else None)
+        self.file_name = file_name
+        self.update_source_layout()
+        self.source_stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if lazy:
+            self.lazy, self.track_budget = lazy, track_budget
+            self.remap_image_data()
+
+    def is_source_unchanged(self, stat:os.stat_result) -> bool:
+        """
+        Return:
+          True if the image file is the same as the one read or written last time (inode, size and mtime), so the source layout matches the file.
+        """
+        return self.source_stat == (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def get_dirty_patches(self):
+        """
+        Return:
+          List of (file offset, data) to bring the source image file up to date. None when a full rewrite is required.
+        """
+        patches = []
+        image_pos = 0
+        for idx in range(len(self.images)):
+            if type(self.images) == LAZY_LIST and not self.images.is_loaded(idx):
+                index_entry = self.images.get_key(idx)      # Not parsed, so not modified
+                if index_entry['offset'] != image_pos:
+                    return None
+                image_pos += index_entry['disk_size']
+                continue
+            image = self.images[idx]
+            if image.source_layout is None or image.source_layout[0] != image_pos:
+                return None                 # New image or the images have been rearranged
+            image_patches = image.get_dirty_patches()
+            if image_patches is None:
+                return None
+            patches.extend([ (image_pos + ofst, data) for ofst, data in image_patches ])
+            image_pos += image.source_layout[1]
+        if image_pos != self.source_size:
+            return None                     # Some images have been removed
+        return patches
+
+    def write_patches(self, f, file_name, patches):
+        """
+        Write the patches in place. The patches are written to the journal file first, so that an interrupted write is completed (or discarded) on the next read_file().  
+            Input parameters:  
+            f = Image file opened (and locked) for update  
+            file_name = Image file name  
+            patches = List of (file offset, data) from get_dirty_patches()  
+        """
+        if len(patches) > 0:
+            journal_file_name = self.get_journal_file_name(file_name)
+            self.write_journal(journal_file_name, patches)
+            for ofst, data in patches:
+                f.seek(ofst)
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            os.remove(journal_file_name)
+            stat = os.fstat(f.fileno())
+            self.source_stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        for idx in range(len(self.images)):
+            if type(self.images) != LAZY_LIST or self.images.is_loaded(idx):
+                image = self.images[idx]
+                image.clear_dirty()
+                if type(image.tracks) == LAZY_LIST:
+                    image.tracks.release_replaced()     # The mapped file has the same data at the same offsets now
+
+    def get_journal_file_name(self, file_name):
+        return file_name + '.journal'
+
+    def write_journal(self, journal_file_name, patches):
+        """
+        Write the patches to a journal file and flush it to the storage.  
+        Format: magic, number of patches, (file offset, size, data) * number of patches, CRC32 of the preceding data
+        """
+        journal = [ self.journal_magic, struct.pack('<I', len(patches)) ]
+        for ofst, data in patches:
+            journal.append(struct.pack('<QI', ofst, len(data)))
+            journal.append(bytes(data))
+        journal = b''.join(journal)
+        with open(journal_file_name, 'wb') as f:
+            f.write(journal)
+            f.write(struct.pack('<I', zlib.crc32(journal)))
+            f.flush()
+            os.fsync(f.fileno())
+        fsync_directory(journal_file_name)
+
+    def read_journal(self, journal_file_name):
+        """
+        Return:
+          List of (file offset, data). None if the journal is incomplete or broken.
+        """
+        with open(journal_file_name, 'rb') as f:
+            journal = f.read()
+        if len(journal) < len(self.journal_magic) + 8 or journal[:len(self.journal_magic)] != self.journal_magic:
+            return None
+        if zlib.crc32(journal[:-4]) != struct.unpack_from('<I', journal, len(journal) - 4)[0]:
+            return None
+        pos = len(self.journal_magic)
+        num_patches = struct.unpack_from('<I', journal, pos)[0]
+        pos += 4
+        patches = []
+        for _ in range(num_patches):
+            ofst, size = struct.unpack_from('<QI', journal, pos)
+            pos += 12
+            patches.append((ofst, journal[pos : pos + size]))
+            pos += size
+        return patches
+
+    def recover_journal(self, file_name):
+        """
+        Complete an interrupted in-place write. A complete journal is replayed to the image file, and an incomplete journal is discarded.  
+        The journal is left as it is (with a warning) when the image file can't be updated (read-only file or media).  
+        Return:
+          True if the journal is replayed
+        """
+        journal_file_name = self.get_journal_file_name(file_name)
+        if not os.path.exists(journal_file_name):
+            return False
+        if not os.access(file_name, os.W_OK) or not os.access(os.path.dirname(os.path.abspath(file_name)), os.W_OK):
+            warnings.warn(f'The journal of an interrupted write is not replayed because the image file is read-only ({journal_file_name})', stacklevel=3)
+            return False
+        with open_locked_file(file_name, 'r+b') as f:
+            if not os.path.exists(journal_file_name):
+                return False                    # Recovered by another process
+            patches = self.read_journal(journal_file_name)
+            if patches is not None:
+                for ofst, data in patches:
+                    f.seek(ofst)
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.remove(journal_file_name)
+        return patches is not None
+
+    def update_source_layout(self):
+        """
+        Record the current layout of the disk images as the source layout for the incremental write.
+        """
+        image_pos = 0
+        for image in self.images:
+            track_table, disk_size = image.calc_track_layout()
+            image.set_source_layout(image_pos, disk_size, track_table, self.calc_track_ends(track_table, disk_size))
+            image_pos += disk_size
+        self.source_size = image_pos
+
+    def detach_image_data(self):
+        """
+        Parse all disk images and tracks, and replace the sector data referring to the loaded image data with their own copies.  
+        self.image_data is released afterwards.
+        """
+        self.images = list(self.images)
+        for image in self.images:
+            if type(image.tracks) == LAZY_LIST:
+                image.tracks.set_budget(None)       # Keep all the tracks. They can't be parsed again without the image data.
+            for track in image.tracks:
+                for sect in track:
+                    if type(sect['sect_data']) == memoryview:
+                        sect['sect_data'] = bytes(sect['sect_data'])
+            image.image_data = None
+        self.image_data = None              # Nothing refers to the loaded image data anymore
+        self.lazy = False
+        self.track_budget = None
+
+    def remap_image_data(self):
+        """
+        Memory-map the image file written by write_file() in lazy mode, and let the tracks be parsed again from it.  
+        The parsed tracks are put under the track budget again, so that they can be dropped after the write.
+        """
+        with open(self.file_name, 'rb') as f:
+            self.image_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.source_size > 0 else b''
+        all_image_data = memoryview(self.image_data)
+        for image in self.images:
+            image_pos, disk_size, track_table, track_ends = image.source_layout
+            image_data = all_image_data[image_pos : image_pos + disk_size]
+            if type(image.tracks) != LAZY_LIST:
+                continue                        # New disk image. All the tracks are kept.
+            parse_track = functools.partial(self.parse_track, image_data, track_table, track_ends)
+            image.tracks.set_loader(parse_track, range(len(image.tracks)), self.track_budget)
+            image.image_data = image_data
 
     def parse_sectors(self, track_data):
         """
@@ -42,48 +587,127 @@ class FLOPPY_IMAGE_D88:
             curr_pos += 0x10                            # skip the header
             sect_data = track_data[curr_pos: curr_pos+data_size]
             curr_pos += data_size
-            res = { 'sect_idx': sect_idx }
-            res.update({'C':C, 'H':H, 'R':R, 'N':N })
-            res.update({'num_sectors': num_sectors})
-            res.update({'density': density})
-            res.update({'data_mark': data_mark})
-            res.update({'status': status})
-            res.update({'data_size': data_size})
-            res.update({'sect_data': sect_data})
+            res = D88_SECTOR(sect_idx, C, H, R, N, num_sectors, density, data_mark, status, data_size, sect_data)
             sect_idx += 1
             sectors.append(res)
         return sectors
 
-    def parse_image(self):
+    def read_d88_header(self, image_data, image_pos):
+        """
+        Return:
+          (disk_name, write_protect, disk_type, disk_size, track_table) of the disk image at image_pos
+        """
+        d88header = struct.unpack_from(f'<17s9xBBI{self.d88_max_track}I', image_data, image_pos)
+        disk_name, write_protect, disk_type, disk_size = d88header[:4]
+        track_table = d88header[4:]
+        return disk_name, write_protect, disk_type, disk_size, track_table
+
+    def calc_track_ends(self, track_table, disk_size):
+        """
+        Calculate the end offset of each track from the track offset table. A track ends at the top of the next existing track.
+        """
+        track_ends = [0] * self.d88_max_track
+        next_ofst = disk_size
+        for track in reversed(range(self.d88_max_track)):
+            if track_table[track] != 0:
+                track_ends[track] = next_ofst
+                next_ofst = track_table[track]
+        return track_ends
+
+    def parse_track(self, image_data, track_table, track_ends, track):
+        track_ofst = track_table[track]
+        if track_ofst == 0:
+            return []
+        return self.parse_sectors(image_data[track_ofst : track_ends[track]])
+
+    def scan_layout(self, index_entry):
+        """
+        Scan the sector headers of a disk image without creating the sector objects.  
+        Return:
+          (track_table, track_ends, sect_headers). sect_headers[track] is a list of (C, H, R, N, num_sectors, density, data_mark, status, data_size).
+        """
+        image_pos = index_entry['offset']
+        disk_name, write_protect, disk_type, disk_size, track_table = self.read_d88_header(self.image_data, image_pos)
+        track_ends = self.calc_track_ends(track_table, disk_size)
+        sect_headers = []
+        for track in range(self.d88_max_track):
+            headers = []
+            if track_table[track] != 0:
+                curr_pos = image_pos + track_table[track]
+                track_end = image_pos + track_ends[track]
+                while curr_pos < track_end:
+                    header = struct.unpack_from('<BBBBHBBB5xH', self.image_data, curr_pos)
+                    headers.append(header)
+                    curr_pos += 0x10 + header[8]
+            sect_headers.append(headers)
+        return track_table, track_ends, sect_headers
+
+    def build_track(self, image_data, track_table, sect_headers, track):
+        """
+        Create the sector objects of a track from the sector headers given by scan_layout().
+        """
+        curr_pos = track_table[track]
+        sectors = []
+        for sect_idx, header in enumerate(sect_headers[track]):
+            curr_pos += 0x10                            # skip the header
+            data_size = header[8]
+            sectors.append(D88_SECTOR(sect_idx, *header, image_data[curr_pos : curr_pos + data_size]))
+            curr_pos += data_size
+        return sectors
+
+    def build_image_index(self):
+        """
+        Build the index of the disk images in the image data by scanning only the D88 headers.  
+        Return:
+          [{'offset':, 'disk_name':, 'write_protect':, 'disk_type':, 'disk_size': }]
+        """
+        image_index = []
         image_pos = 0
         total_image_size = len(self.image_data)
         while image_pos < total_image_size:
-            d88header = struct.unpack_from(f'<17s9xBBI{self.d88_max_track}I', self.image_data, 0)
-            disk_name, write_protect, disk_type, disk_size = d88header[:4]
-            track_table = d88header[4:]
-            image_data = self.image_data[image_pos : image_pos + disk_size + 1]
-            disk_image = FLOPPY_DISK_D88()
-            disk_image.set_meta_data(disk_name = disk_name,
-                                      write_protect = write_protect,
-                                      disk_type = disk_type)
+            disk_name, write_protect, disk_type, disk_size = struct.unpack_from('<17s9xBBI', self.image_data, image_pos)
+            if disk_size == 0 or image_pos + disk_size > total_image_size:
+                raise ValueError(f'Broken D88 header (offset=0x{image_pos:x}, disk size=0x{disk_size:x})')
+            image_index.append({ 'offset':image_pos, 'disk_name':disk_name, 'write_protect':write_protect, 'disk_type':disk_type, 'disk_size':disk_size })
+            image_pos += disk_size
+        return image_index
+
+    def parse_disk_image(self, index_entry):
+        """
+        Parse a disk image in the image data. index_entry is an entry of self.image_index.
+        """
+        image_pos = index_entry['offset']
+        disk_name, write_protect, disk_type, disk_size = index_entry['disk_name'], index_entry['write_protect'], index_entry['disk_type'], index_entry['disk_size']
+        # Slicing a memoryview doesn't copy the data. The sectors keep referring to self.image_data in zero-copy mode.
+        all_image_data = memoryview(self.image_data) if self.zero_copy else self.image_data
+        image_data = all_image_data[image_pos : image_pos + disk_size]
+        if 'layout' in index_entry:                     # Cached layout. No need to scan the sector headers.
+            track_table, track_ends, sect_headers = index_entry['layout']
+            parse_track = functools.partial(self.build_track, image_data, track_table, sect_headers)
+        else:
+            disk_name, write_protect, disk_type, disk_size, track_table = self.read_d88_header(self.image_data, image_pos)
+            track_ends = self.calc_track_ends(track_table, disk_size)
+            parse_track = functools.partial(self.parse_track, image_data, track_table, track_ends)
+        disk_image = FLOPPY_DISK_D88()
+        disk_image.set_meta_data(disk_name = disk_name,
+                                  write_protect = write_protect,
+                                  disk_type = disk_type)
+        if self.lazy:
+            disk_image.tracks = LAZY_LIST(range(self.d88_max_track), parse_track, self.track_budget, disk_image.release_track)
+        else:
             for track in range(self.d88_max_track):        # D88 image max track num == 163
-                track_ofst = track_table[track]
-                if track_ofst != 0:
-                    if track < 163:
-                        track_end = track_table[track + 1]
-                    else:
-                        track_end = disk_size
-                    track_size = track_end - track_ofst
-                    track_data = image_data[track_ofst : track_end]
-                else:
-                    track_size = 0
-                    track_data = []
-
-                sectors = self.parse_sectors(track_data)
-                disk_image.tracks[track] = sectors
-            
-            self.images.append(disk_image)
-            image_pos += disk_size 
+                disk_image.tracks[track] = parse_track(track)
+        disk_image.set_source_layout(image_pos, disk_size, track_table, track_ends)
+        if self.zero_copy:
+            disk_image.image_data = image_data      # memoryview. Used to compare the tracks without parsing the sectors.
+        return disk_image
+
+    def parse_image(self):
+        """
+        Index the disk images in the image data. Each disk image is parsed on the first access to self.images[n].
+        """
+        self.image_index = self.build_image_index()
+        self.images = LAZY_LIST(self.image_index, self.parse_disk_image)
  
     def create_and_add_new_empty_image(self):
         new_image = FLOPPY_DISK_D88()
@@ -97,28 +721,363 @@ class FLOPPY_IMAGE_D88:
         """
         Reconstruct self.image_data from current contents.
         """
-        self.image_data = bytearray()
-        for image in self.images:
-            new_disk_image = image.reconstruct_image_data()
-            self.image_data += new_disk_image
+        disk_sizes = [ image.calc_track_layout()[1] for image in self.images ]
+        self.image_data = bytearray(sum(disk_sizes))
+        image_pos = 0
+        for image, disk_size in zip(self.images, disk_sizes):
+            image.reconstruct_image_data(self.image_data, image_pos)
+            image_pos += disk_size
 
     def get_num_images(self) -> int:
         return len(self.images)
 
 
+compressed_file_openers = { '.gz':gzip.open, '.xz':lzma.open, '.bz2':bz2.open }
+
+def is_streamed_source(file_name):
+    """
+    Return:
+      True if the file is a compressed file or a member of a zip archive, which can't be accessed randomly.
+    """
+    file_name = os.fspath(file_name)
+    if '!' in file_name and not os.path.isfile(file_name):
+        return True
+    return os.path.splitext(file_name)[1].lower() in compressed_file_openers
+
+@contextlib.contextmanager
+def open_image_source(file_name):
+    """
+    Context manager. Open a compressed file ('image.d88.gz') or a member of a zip archive ('library.zip!/game.d88', 'library.zip!/game.d88.gz') for streaming read.  
+    Return:
+      Binary file object
+    """
+    file_name = os.fspath(file_name)
+    with contextlib.ExitStack() as stack:
+        if '!' in file_name and not os.path.isfile(file_name):
+            archive_name, member_name = file_name.split('!', 1)
+            if not os.path.isfile(archive_name):
+                raise FileNotFoundError(archive_name)
+            archive = stack.enter_context(zipfile.ZipFile(archive_name))
+            try:
+                f = stack.enter_context(archive.open(member_name.lstrip('/')))
+            except KeyError:
+                raise FileNotFoundError(file_name) from None
+        else:
+            if not os.path.isfile(file_name):
+                raise FileNotFoundError(file_name)
+            member_name = file_name
+            f = stack.enter_context(open(file_name, 'rb'))
+        opener = compressed_file_openers.get(os.path.splitext(member_name)[1].lower())
+        if opener is not None:
+            f = stack.enter_context(opener(f))
+        yield f
+
+def read_exact(f, size):
+    data = f.read(size)
+    if len(data) == size or len(data) == 0:
+        return data
+    chunks = [ data ]
+    while size > 0 and len(data) > 0:
+        size -= len(data)
+        data = f.read(size)
+        chunks.append(data)
+    return b''.join(chunks)
+
+def write_file_atomically(file_name, write_func, before_replace=None):
+    """
+    Write a file through a temporary file. write_func(f) writes the contents to the temporary file,
+    and the temporary file replaces the file after it is flushed to the storage.  
+    before_replace() is called right before the replacement (e.g. to close the file to be replaced).  
+    Return:
+      os.stat_result of the written file
+    """
+    tmp_file_name = f'{file_name}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_file_name, 'wb') as f:
+            write_func(f)
+            f.flush()
+            os.fsync(f.fileno())
+            stat = os.fstat(f.fileno())
+        if os.path.isfile(file_name):
+            os.chmod(tmp_file_name, os.stat(file_name).st_mode & 0o7777)
+        if before_replace is not None:
+            before_replace()
+        os.replace(tmp_file_name, file_name)
+    except BaseException:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+        raise
+    fsync_directory(file_name)
+    return stat
+
+def lock_file(f):
+    """
+    Lock an open file exclusively until it is closed (no-op where fcntl is not available).
+    """
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+@contextlib.contextmanager
+def open_locked_file(file_name, mode='rb'):
+    """
+    Context manager. Open an existing file and lock it exclusively until it is closed.  
+    The file is opened again if it has been replaced (by write_file_atomically()) while waiting for the lock.
+    """
+    while True:
+        f = open(file_name, mode)
+        try:
+            lock_file(f)
+            if fcntl is None or os.path.samestat(os.fstat(f.fileno()), os.stat(file_name)):
+                break
+        except BaseException:
+            f.close()
+            raise
+        f.close()
+    with f:
+        yield f
+
+def fsync_directory(file_name):
+    """
+    Flush the directory entry of a file (created, renamed or removed) to the storage. Not supported on Windows.
+    """
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(file_name)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _parse_disk_image_worker(file_name, index_entry):
+    """
+    Parse a disk image in an image file. Runs in a worker process of FLOPPY_IMAGE_D88.load_all_images().
+    """
+    image_file = FLOPPY_IMAGE_D88()
+    with open(file_name, 'rb') as f:
+        f.seek(index_entry['offset'])
+        image_file.image_data = f.read(index_entry['disk_size'])
+    disk_image = image_file.parse_disk_image({ **index_entry, 'offset':0 })
+    image_ofst, disk_size, track_table, track_ends = disk_image.source_layout
+    disk_image.set_source_layout(index_entry['offset'], disk_size, track_table, track_ends)
+    return disk_image
+
+
 class FLOPPY_DISK_D88:
     def __init__(self):
         self.image_data = None
         self.optional_args = {}
         self.sect_per_track = 16
         self.d88_max_track = 164
+        self.dirty_tracks = set()
+        self._shared_tracks = set()             # Tracks sharing the track list and the sector objects with snapshots
+        self._transactions = []
+        self._write_count = 0
         self.tracks = [[] for _ in range(self.d88_max_track)]
 
+    @property
+    def tracks(self):
+        return self._tracks
+
+    @tracks.setter
+    def tracks(self, tracks):
+        self._tracks = tracks
+        self._shared_tracks = set()
+        self.invalidate_track_versions()
+        self.invalidate_sector_index()
+        self.source_layout = None               # The layout is not related to the source image anymore
+
+    def prepare_track_write(self, track) -> bool:
+        """
+        Copy-on-write. Give the track its own track list and sector objects before modifying the sectors,
+        if the track is shared with a snapshot or the original track must be kept for rollback().  
+        Return:
+          True if the track is copied (the sector objects obtained before this call are not in the track anymore)
+        """
+        if len(self._transactions) > 0 and track not in self._transactions[-1]['tracks']:
+            self._transactions[-1]['tracks'][track] = self._tracks[track]
+        elif track not in self._shared_tracks:
+            return False
+        self._tracks[track] = [ sect.copy() for sect in self._tracks[track] ]
+        self._shared_tracks.discard(track)
+        self.invalidate_sector_index(track)
+        return True
+
+    def snapshot(self):
+        """
+        Return a copy of this disk image. The track lists and the sector objects are shared until either one of the disk images writes to the track (copy-on-write).
+        """
+        clone = FLOPPY_DISK_D88()
+        if hasattr(self, 'disk_name'):
+            clone.set_meta_data(self.disk_name, self.write_protect, self.disk_type)
+        clone.sect_per_track = self.sect_per_track
+        clone.tracks = list(self._tracks)
+        clone._shared_tracks = set(range(len(clone.tracks)))
+        self._shared_tracks = set(range(len(self._tracks)))
+        return clone
+
+    def begin(self):
+        """
+        Start a transaction. Only the tracks modified in the transaction are copied. Transactions can be nested.
+        """
+        self._transactions.append({ 'container':self._tracks,
+                                    'tracks':{},
+                                    'shared_tracks':set(self._shared_tracks),
+                                    'dirty_tracks':set(self.dirty_tracks),
+                                    'meta':(self.disk_name, self.write_protect, self.disk_type) if hasattr(self, 'disk_name') else None,
+                                    'source_layout':self.source_layout })
+
+    def commit(self):
+        if len(self._transactions) == 0:
+            raise ValueError('No transaction')
+        transaction = self._transactions.pop()
+        if len(self._transactions) > 0:
+            for track, track_data in transaction['tracks'].items():
+                self._transactions[-1]['tracks'].setdefault(track, track_data)
+
+    def rollback(self):
+        """
+        Discard the changes since begin().
+        """
+        if len(self._transactions) == 0:
+            raise ValueError('No transaction')
+        transaction = self._transactions.pop()
+        self._tracks = transaction['container']
+        for track, track_data in transaction['tracks'].items():
+            self._tracks[track] = track_data
+        self._shared_tracks = transaction['shared_tracks']
+        self.source_layout = transaction['source_layout']
+        # The tracks might have been written to the image file in the transaction
+        self.dirty_tracks = transaction['dirty_tracks'] | set(transaction['tracks'])
+        if transaction['meta'] is not None:
+            self.set_meta_data(*transaction['meta'])
+        self.invalidate_track_versions()
+        self.invalidate_sector_index()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager. Commits the transaction at the end of the block, or rolls it back when an exception is raised.
+        """
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def set_source_layout(self, image_ofst, disk_size, track_table, track_ends):
+        """
+        Record where this disk image and its tracks are stored in the source image file. Used for the incremental write.
+        """
+        self.source_layout = (image_ofst, disk_size, track_table, track_ends)
+        self.clear_dirty()
+
+    def mark_dirty(self, track):
+        """
+        Mark a track as modified. Call this after modifying the sectors in a track directly.
+        """
+        self.dirty_tracks.add(track)
+        self._write_count += 1
+        self._track_versions[track] = self._write_count
+
+    def get_track_version(self, track) -> int:
+        """
+        Return a number which changes whenever the track is modified. Used to validate the data decoded from the sectors (e.g. a directory cache).
+        """
+        return self._track_versions.get(track, self._base_version)
+
+    def invalidate_track_versions(self):
+        """
+        Change the versions of all tracks (the track lists are replaced or rolled back).
+        """
+        self._write_count += 1
+        self._base_version = self._write_count
+        self._track_versions = {}
+
+    def release_track(self, track) -> bool:
+        """
+        Called before a parsed track is dropped from the memory (see FLOPPY_IMAGE_D88.read_file(max_cached_tracks=)).  
+        Return:
+          False if the track must be kept (modified and not written yet)
+        """
+        if track in self.dirty_tracks:
+            return False
+        self.invalidate_sector_index(track)     # The index refers to the sector objects in the track
+        return True
+
+    def clear_dirty(self):
+        self.dirty_tracks = set()
+        self.source_header = self.reconstruct_d88_header(0)
+        self.image_data = None                  # The loaded image data doesn't represent the source image anymore
+
+    def get_source_track_data(self, track):
+        """
+        Return the image data of a track as it was loaded from the image file.  
+        None if the track is modified or the disk image isn't loaded in zero-copy mode.
+        """
+        if self.image_data is None or self.source_layout is None or track in self.dirty_tracks:
+            return None
+        image_ofst, disk_size, track_table, track_ends = self.source_layout
+        if track >= len(track_table):
+            return None
+        return self.image_data[track_table[track] : track_ends[track]]
+
+    def get_dirty_patches(self):
+        """
+        Return:
+          List of (offset in the disk image, data) to update the source image with the modified tracks.  
+          None when the layout of the disk image has been changed from the source image (a full rewrite is required).
+        """
+        if self.source_layout is None:
+            return None
+        image_ofst, disk_size, track_table, track_ends = self.source_layout
+        patches = []
+        d88_hdr = self.reconstruct_d88_header(0)
+        if d88_hdr != self.source_header:
+            patches.append((0, d88_hdr[:0x1c]))         # Disk name, write protect flag and disk type
+        for track in sorted(self.dirty_tracks):
+            track_img = self.reconstruct_track_image(track)
+            if track_table[track] == 0 or len(track_img) != track_ends[track] - track_table[track]:
+                return None
+            patches.append((track_table[track], track_img))
+        return patches
+
     def set_meta_data(self, disk_name, write_protect, disk_type):
         self.disk_name = disk_name
         self.write_protect = write_protect
         self.disk_type = disk_type
 
+    def invalidate_sector_index(self, track=None):
+        """
+        Discard the sector lookup index of a track (or all tracks when track is None).  
+        The index refers to the sector objects, so call this after replacing the sectors in a track list directly.
+        """
+        if track is None:
+            self._sect_index = {}
+        else:
+            self._sect_index.pop(track, None)
+
+    def get_sector_index(self, track):
+        """
+        Return the sector lookup index of a track, (R index, (C, H, R) index). The index is built on the first use.  
+        When a track has multiple sectors with the same ID, the first one is indexed as the linear search did.
+        """
+        track_data = self._tracks[track]
+        index = self._sect_index.get(track)
+        if index is None or index[0] is not track_data or index[1] != len(track_data):
+            R_index = {}
+            CHR_index = {}
+            for sect in track_data:
+                R_index.setdefault(sect.R, sect)
+                CHR_index.setdefault((sect.C, sect.H, sect.R), sect)
+            index = (track_data, len(track_data), R_index, CHR_index)
+            self._sect_index[track] = index
+        return index[2], index[3]
+
     def read_sector(self, track, sect_id, ignoreCH = True):
         """
         Read a sector. Use track number and sector ID (C, H, R) to specify the sector.  
@@ -130,27 +1089,71 @@ class FLOPPY_DISK_D88:
         if track < 0 or track >= len(self.tracks):
             raise ValueError
         C, H, R = sect_id
-        for sect in self.tracks[track]:
-            match = False
-            if ignoreCH:
-                if sect['R'] == R:
-                    match = True
-            else:
-                if sect['C'] == C and sect['H'] == H and sect['R'] == R:
-                    match = True
-            if match:
-                return sect
-        return None
+        R_index, CHR_index = self.get_sector_index(track)
+        if ignoreCH:
+            return R_index.get(R)
+        return CHR_index.get((C, H, R))
 
     def read_sector_LBA(self, LBA):
         """
         Read a sector. Use LBA to specify the sector. LBA starts from 0 and LBA=0 represents the CHR=(0,0,1)
         """
         track = LBA // self.sect_per_track
-        C = track // 2
-        H = track % 2
-        R = LBA % self.sect_per_track + 1
-        return self.read_sector(track, (C, H, R), True)
+        if track < 0 or track >= len(self.tracks):
+            raise ValueError
+        R_index, CHR_index = self.get_sector_index(track)     # Validated against the current track list
+        return R_index.get(LBA % self.sect_per_track + 1)
+
+    def get_sectors_LBA(self, start, count) -> list:
+        sectors = []
+        for LBA in range(start, start + count):
+            sect = self.read_sector_LBA(LBA)
+            if sect is None:
+                raise ValueError(f'Sector not found (LBA={LBA})')
+            sectors.append(sect)
+        return sectors
+
+    def readinto_sectors_LBA(self, start, count, buffer) -> int:
+        """
+        Read contiguous sectors specified by LBA into a buffer provided by the caller.  
+            Input parameters:  
+            start = LBA of the first sector  
+            count = Number of sectors to read  
+            buffer = Writable bytes-like object (bytearray, memoryview, etc)  
+        Return:
+          Number of bytes read
+        """
+        dest = memoryview(buffer)
+        pos = 0
+        for sect in self.get_sectors_LBA(start, count):
+            size = len(sect.sect_data)
+            if pos + size > len(dest):
+                raise ValueError('Buffer is too small')
+            dest[pos : pos + size] = sect.sect_data
+            pos += size
+        return pos
+
+    def read_sectors_LBA(self, start, count) -> memoryview:
+        """
+        Read contiguous sectors specified by LBA (e.g. a cluster or a track).  
+        A single sector is returned as a read-only view of the sector data without copying.  
+        Multiple sectors are copied into a new buffer at once (D88 has a sector header in front of every sector, so the sector data are never contiguous in the source image).  
+            Input parameters:  
+            start = LBA of the first sector  
+            count = Number of sectors to read  
+        Return:
+          memoryview of the sector data
+        """
+        sectors = self.get_sectors_LBA(start, count)
+        if len(sectors) == 1:
+            return memoryview(sectors[0].sect_data).toreadonly()
+        buffer = bytearray(sum([ len(sect.sect_data) for sect in sectors ]))
+        pos = 0
+        for sect in sectors:
+            size = len(sect.sect_data)
+            buffer[pos : pos + size] = sect.sect_data
+            pos += size
+        return memoryview(buffer)
 
     def read_sector_idx(self, track, sect_idx):
         """
@@ -179,6 +1182,26 @@ class FLOPPY_DISK_D88:
         for idx, sect in enumerate(track):
             sect['sect_idx'] = idx
 
+    def get_sector_size_code(self, data_size) -> int:
+        """
+        Return:
+          Sector size code N (data_size = 128 << N). ValueError if data_size is not a valid sector size (128, 256, ..., 16384).
+        """
+        if data_size < 128 or data_size > 16384 or data_size & (data_size - 1) != 0:
+            raise ValueError(f'Invalid sector size ({data_size})')
+        return data_size.bit_length() - 8
+
+    def round_up_sector_data(self, write_data:bytearray) -> bytearray:
+        """
+        Pad the sector data with 0x00 to the next valid sector size (power of 2, 128 bytes at least).
+        """
+        size = len(write_data)
+        data_size = 128 if size <= 128 else 1 << (size - 1).bit_length()
+        if data_size != size:
+            warnings.warn(f'Sector data size is rounded up to power of 2 ({size} -> {data_size})', stacklevel=3)
+            write_data.extend(bytes(data_size - size))
+        return write_data
+
     def write_sector(self, track, sect_id = None, write_data=None, density=0x00, data_mark=0x00, status=0x00, ignoreCH = True, create_new=False):
         """
         Write data to a sector. Use track number and sector ID (C, H, R) to specify the sector.  
@@ -189,12 +1212,11 @@ class FLOPPY_DISK_D88:
             ignoreCH = Ignores C and H parameters and cares only R  
             create_new = Create a new sector when the specified sector does not exist  
         """
-        write_data = bytearray(write_data)
+        write_data = bytearray(write_data)                  # A private copy. A zero-copy sector (memoryview) is detached from the image data here.
         sect = self.read_sector(track, sect_id, ignoreCH)
-        data_size = int(math.pow(2, math.ceil(math.log(len(write_data))/math.log(2))))       # round up the data size to power of 2
-        if data_size != len(write_data):
-            print(f'WARNING: data size is rounded up to power of 2 ({len(write_data)} -> {data_size})')
-            write_data.extend(bytearray(data_size - len(write_data)))
+        if (sect is not None or create_new) and self.prepare_track_write(track):
+            sect = self.read_sector(track, sect_id, ignoreCH)
+        write_data = self.round_up_sector_data(write_data)
         if sect is not None:
             #sect['sect_idx'] = x       # no change
             sect['sect_data'] = write_data
@@ -204,25 +1226,26 @@ class FLOPPY_DISK_D88:
             sect['density'] = density
             #sect['num_sectors']        # no change
             assert id(sect) == id(self.tracks[track][sect['sect_idx']])
+            self.mark_dirty(track)
         elif create_new:
             C, H, R = sect_id
-            N = int(math.log(len(write_data))/math.log(2))-7
-            new_sector = {
-                'sect_idx': len(self.tracks),
-                'C': C,
-                'H': H,
-                'R': R,
-                'N': N,
-                'num_sectors': 1,           # dummy
-                'density': density,
-                'data_mark': data_mark,
-                'status': status,
-                'data_size': len(write_data),
-                'sect_data': write_data
-            }
+            N = self.get_sector_size_code(len(write_data))
+            new_sector = D88_SECTOR(sect_idx = len(self.tracks[track]),
+                                    C = C,
+                                    H = H,
+                                    R = R,
+                                    N = N,
+                                    num_sectors = 1,           # dummy
+                                    density = density,
+                                    data_mark = data_mark,
+                                    status = status,
+                                    data_size = len(write_data),
+                                    sect_data = write_data)
             self.tracks[track].append(new_sector)
             self.adjust_num_sectors(self.tracks[track])
             self.renumber_sect_idx(self.tracks[track])
+            self.invalidate_sector_index(track)
+            self.mark_dirty(track)
 
     def write_sector_LBA(self, LBA, write_data=None, density=0x00, data_mark=0x00, status=0x00, create_new=False):
         """
@@ -240,12 +1263,11 @@ class FLOPPY_DISK_D88:
           track = Track number (0-163)  
           sect_idx = The sector index is counted from the top of the track starts with 0. Use sect_id instead of sect_idx when None is set.
         """
-        write_data = bytearray(write_data)
+        write_data = bytearray(write_data)                  # A private copy. A zero-copy sector (memoryview) is detached from the image data here.
         sect = self.read_sector_idx(track, sect_idx)
-        data_size = int(math.pow(2, math.ceil(math.log(len(write_data))/math.log(2))))       # round up the data size to power of 2
-        if data_size != len(write_data):
-            print(f'WARNING: data size is rounded up to power of 2 ({len(write_data)} -> {data_size})')
-            write_data.extend(bytearray(data_size - len(write_data)))
+        if sect is not None and self.prepare_track_write(track):
+            sect = self.read_sector_idx(track, sect_idx)
+        write_data = self.round_up_sector_data(write_data)
         if sect is not None:
             #sect['sect_idx'] = x       # no change
             sect['sect_data'] = write_data
@@ -255,23 +1277,112 @@ class FLOPPY_DISK_D88:
             sect['density'] = density
             #sect['num_sectors']        # no change
             assert id(sect) == id(self.tracks[track][sect['sect_idx']])
+            self.mark_dirty(track)
+
+    def write_sectors(self, sectors, density=0x00, data_mark=0x00, status=0x00, ignoreCH = True):
+        """
+        Write multiple sectors at once. The sectors which don't exist are appended to the track (same as write_sector(..., create_new=True)).  
+        The number of sectors and the sector indices are fixed up once per track after all the sectors are written.  
+            Input parameters:  
+            sectors = Iterable of (track, (C, H, R), data) or (track, (C, H, R), data, density, data_mark, status)  
+            density, data_mark, status = Default sector attributes for the items without them  
+            ignoreCH = Ignores C and H parameters and cares only R to find the existing sectors  
+        The data size must be a valid sector size (128, 256, ..., 16384). ValueError is raised otherwise.
+        """
+        items = []                                          # All the items are validated before modifying any track
+        for track, sect_id, write_data, *attrs in sectors:
+            if track < 0 or track >= len(self._tracks):
+                raise ValueError(f'Track out of range ({track})')
+            sect_density, sect_data_mark, sect_status = attrs if len(attrs) > 0 else (density, data_mark, status)
+            C, H, R = sect_id
+            N = self.get_sector_size_code(len(write_data))
+            items.append((track, C, H, R, N, bytearray(write_data), sect_density, sect_data_mark, sect_status))
+
+        touched = {}                                        # track: (R index, (C, H, R) index)
+        for track, C, H, R, N, write_data, sect_density, sect_data_mark, sect_status in items:
+            if track not in touched:
+                self.prepare_track_write(track)
+                R_index, CHR_index = self.get_sector_index(track)
+                touched[track] = (dict(R_index), dict(CHR_index))
+            R_index, CHR_index = touched[track]
+            sect = R_index.get(R) if ignoreCH else CHR_index.get((C, H, R))
+            if sect is None:
+                track_data = self._tracks[track]
+                sect = D88_SECTOR(len(track_data), C, H, R, N, 0, sect_density, sect_data_mark, sect_status, len(write_data), write_data)
+                track_data.append(sect)
+                R_index.setdefault(R, sect)
+                CHR_index.setdefault((C, H, R), sect)
+            else:
+                sect.N = N
+                sect.sect_data = write_data
+                sect.data_size = len(write_data)
+                sect.status = sect_status
+                sect.data_mark = sect_data_mark
+                sect.density = sect_density
+        for track in touched:
+            self.adjust_num_sectors(self._tracks[track])
+            self.renumber_sect_idx(self._tracks[track])
+            self.invalidate_sector_index(track)
+            self.mark_dirty(track)
+
+    def write_track(self, track, sectors, density=0x00, data_mark=0x00, status=0x00):
+        """
+        Replace all the sectors in a track. The sectors are placed in the given order, so any sector layout (interleave, duplicated IDs, mixed sizes, etc) can be made.  
+            Input parameters:  
+            track = Track number (0-163)  
+            sectors = Iterable of ((C, H, R), data) or ((C, H, R), data, density, data_mark, status)  
+            density, data_mark, status = Default sector attributes for the items without them  
+        The data size must be a valid sector size (128, 256, ..., 16384). ValueError is raised otherwise.
+        """
+        if track < 0 or track >= len(self._tracks):
+            raise ValueError(f'Track out of range ({track})')
+        track_data = []
+        for sect_id, write_data, *attrs in sectors:
+            sect_density, sect_data_mark, sect_status = attrs if len(attrs) > 0 else (density, data_mark, status)
+            C, H, R = sect_id
+            N = self.get_sector_size_code(len(write_data))
+            track_data.append(D88_SECTOR(len(track_data), C, H, R, N, 0, sect_density, sect_data_mark, sect_status, len(write_data), bytearray(write_data)))
+        self.adjust_num_sectors(track_data)
+        self.replace_track(track, track_data)
+
+    def replace_track(self, track, track_data):
+        """
+        Replace the track list of a track with a new list. The old track list is kept for rollback(), and the new one is not shared with the snapshots.  
+        The sector attributes (num_sectors, sect_idx) in the new list are not fixed up.
+        """
+        if track < 0 or track >= len(self._tracks):
+            raise ValueError(f'Track out of range ({track})')
+        if len(self._transactions) > 0 and track not in self._transactions[-1]['tracks']:
+            self._transactions[-1]['tracks'][track] = self._tracks[track]
+        self._tracks[track] = track_data
+        self._shared_tracks.discard(track)
+        self.invalidate_sector_index(track)
+        self.mark_dirty(track)
+
+    def set_num_tracks(self, num_tracks):
+        """
+        Change the number of tracks. The tracks beyond num_tracks are removed and the missing tracks are added as empty tracks.
+        """
+        shared_tracks = { track for track in self._shared_tracks if track < num_tracks }
+        tracks = list(self._tracks)[:num_tracks]
+        tracks.extend([ [] for _ in range(num_tracks - len(tracks)) ])
+        self.tracks = tracks                                # The old container is kept by begin() for rollback()
+        self._shared_tracks = shared_tracks
 
     def create_new_sector(self, C, H, R, N, status, data_mark, density, sect_idx=-1, num_sectors=-1):
             sect_data_size = 2 ** (7+N)
             sect_data = bytearray([0x00] * sect_data_size)
-            sect = {
-                'sect_idx': sect_idx,
-                'C': C,
-                'H': H,
-                'R': R,
-                'N': N,
-                'sect_data': sect_data,
-                'data_size': sect_data_size,
-                'status': status,
-                'data_mark': data_mark,
-                'density': density,
-                'num_sectors': num_sectors
-            }
+            sect = D88_SECTOR(sect_idx = sect_idx,
+                              C = C,
+                              H = H,
+                              R = R,
+                              N = N,
+                              sect_data = sect_data,
+                              data_size = sect_data_size,
+                              status = status,
+                              data_mark = data_mark,
+                              density = density,
+                              num_sectors = num_sectors)
             return sect
 
     def create_new_track(self, C, H):
@@ -298,46 +1409,65 @@ class FLOPPY_DISK_D88:
 
 
 
-    def encode_to_hex(self, data):
-        res = ''
-        for dt in data:
-            res += f'{dt:02x} '
-        if res != '':
-            res = res[:-1]
-        return res
+    def encode_to_hex(self, data) -> str:
+        return data.hex(' ')
 
     def decode_from_hex(self, data:str) -> bytearray:
-        res = []
-        data = data.replace(' ', '')
-        assert len(data) % 2 == 0
-        #for pos in range(0, len(data), 2):
-        #    hex_str = data[pos:pos+1+1]
-        #    val = int(hex_str, 16)
-        #    res.append(val)
-        res = bytes().fromhex(data)
-        return bytearray(res)
+        return bytearray.fromhex(data)          # Spaces between the bytes are ignored
 
+    def encode_track(self, track:int, hex_dump=False) -> list[dict]:
+        """
+        Return a serializable copy of a track. The sector objects in the track are not modified.  
+            Input parameters:  
+            track = Track number  
+            hex_dump = Encode the sector data in hex string instead of base64  
+        """
+        res = []
+        for sect in self.tracks[track]:
+            sect_dict = sect.to_dict()
+            if hex_dump:
+                sect_dict['sect_data'] = self.encode_to_hex(sect.sect_data)
+            else:
+                sect_dict['sect_data'] = base64.b64encode(sect.sect_data).decode()
+            res.append(sect_dict)
+        return res
 
+    def decode_track(self, track_data:list[dict], hex_dump=False) -> list[D88_SECTOR]:
+        res = []
+        for sect in track_data:
+            sect = dict(sect)
+            if hex_dump:
+                sect['sect_data'] = self.decode_from_hex(sect['sect_data'])
+            else:
+                sect['sect_data'] = base64.b64decode(sect['sect_data'])
+            res.append(D88_SECTOR(**sect))
+        return res
 
     def serialize(self, file_name:str, hex_dump=False):
+        """
+        Write the tracks to a JSON or YAML file. The tracks are encoded and written one by one.  
+            Input parameters:  
+            file_name = Output file name. The file format is determined by the extension ('.json', '.yaml' or '.yml').  
+            hex_dump = Encode the sector data in hex string instead of base64  
+        """
         root, ext = os.path.splitext(file_name)
         ext = ext.upper()
-        tracks_copy = self.tracks.copy()
-        # Encode sector data
-        for track in tracks_copy:
-            for sect in track:
-                if hex_dump:
-                    sect['sect_data'] = self.encode_to_hex(sect['sect_data'])
-                else:
-                    sect['sect_data'] = base64.b64encode(sect['sect_data']).decode()
+        if ext not in ('.JSON', '.YAML', '.YML'):
+            raise ValueError
         with open(file_name, 'wt') as f:
             match ext:
                 case '.JSON':
-                    json.dump(tracks_copy, f, indent=4)
+                    f.write('[')
+                    for track in range(len(self.tracks)):
+                        f.write('\n' if track == 0 else ',\n')
+                        f.write(json.dumps(self.encode_track(track, hex_dump)))
+                    f.write('\n]\n')
                 case '.YAML' | '.YML':
-                    yaml.dump(self.tracks, f)
-                case _:
-                    raise ValueError
+                    if len(self.tracks) == 0:
+                        f.write('[]\n')
+                    for track in range(len(self.tracks)):
+                        # Each document is a single item list. Concatenated documents make the list of the tracks.
+                        yaml.dump([ self.encode_track(track, hex_dump) ], f, Dumper=YAML_DUMPER)
 
     def deserialize(self, file_name:str, hex_dump=False):
         root, ext = os.path.splitext(file_name)
@@ -347,19 +1477,96 @@ class FLOPPY_DISK_D88:
                 case '.JSON':
                     tracks = json.load(f)
                 case '.YAML' | '.YML':
-                    tracks = yaml.safe_load(f)
+                    tracks = yaml.load(f, Loader=YAML_LOADER)
                 case _:
                     raise ValueError
-        # Decode sector data
-        for track in tracks:
-            for sect in track:
-                if hex_dump:
-                    sect['sect_data'] = self.decode_from_hex(sect['sect_data'])
-                else:
-                    sect['sect_data'] = base64.b64decode(sect['sect_data'])
-        self.tracks = tracks
+        self.tracks = [ self.decode_track(track, hex_dump) for track in tracks ]
 
-    def reconstruct_sector_image(self, sect) -> bytes:
+    def as_array(self, by_id=True):
+        """
+        Return the sector data of the whole disk as NumPy arrays for vectorized analysis. All sectors must have the same size. NumPy is required.  
+        The data array is a read-only view over the loaded image data (no copy) when the image file is read with zero_copy or lazy,
+        all sectors exist, they are not modified, and they are placed at a constant interval in the image data. Otherwise the sector data are copied.  
+            Input parameters:  
+            by_id = Place the sectors in the order of sector ID (R=1 goes to [track][0]). In the physical order in the track when False.  
+        Return:
+          (data, mask, headers)  
+          data = uint8 array shaped (tracks, sectors, sector_size). Missing sectors are filled with 0.  
+          mask = bool array shaped (tracks, sectors). True where the sector exists.  
+          headers = Structured array shaped (tracks, sectors) with C, H, R, N, density, data_mark and status fields.  
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError('NumPy is required for FLOPPY_DISK_D88.as_array()') from None
+        num_tracks = 0
+        num_sects = 0
+        sect_size = None
+        for track, track_data in enumerate(self.tracks):
+            if len(track_data) == 0:
+                continue
+            num_tracks = track + 1
+            num_sects = max(num_sects, len(track_data))
+            for sect in track_data:
+                if sect_size is None:
+                    sect_size = len(sect.sect_data)
+                elif len(sect.sect_data) != sect_size:
+                    raise ValueError(f'Sector size is not uniform (track {track}, R={sect.R})')
+        sect_size = 0 if sect_size is None else sect_size
+
+        slots = [ [ None ] * num_sects for _ in range(num_tracks) ]
+        for track in range(num_tracks):
+            for sect_idx, sect in enumerate(self.tracks[track]):
+                slot = sect.R - 1 if by_id else sect_idx
+                if slot < 0 or slot >= num_sects or slots[track][slot] is not None:
+                    raise ValueError(f'Sector ID R={sect.R} in track {track} doesn\'t fit in the array')
+                slots[track][slot] = sect
+
+        header_dtype = np.dtype([ (name, np.uint8) for name in ('C', 'H', 'R', 'N', 'density', 'data_mark', 'status') ])
+        empty_header = (0, 0, 0, 0, 0, 0, 0)
+        headers = np.array([ [ empty_header if sect is None else (sect.C, sect.H, sect.R, sect.N, sect.density, sect.data_mark, sect.status)
+                               for sect in track_slots ] for track_slots in slots ], dtype=header_dtype).reshape(num_tracks, num_sects)
+        mask = np.array([ [ sect is not None for sect in track_slots ] for track_slots in slots ], dtype=bool).reshape(num_tracks, num_sects)
+
+        data = self.get_array_view(np, slots, sect_size) if mask.all() else None
+        if data is None:
+            data = np.zeros((num_tracks, num_sects, sect_size), dtype=np.uint8)
+            for track, track_slots in enumerate(slots):
+                for slot, sect in enumerate(track_slots):
+                    if sect is not None:
+                        data[track, slot] = np.frombuffer(sect.sect_data, dtype=np.uint8)
+        return data, mask, headers
+
+    def get_array_view(self, np, slots, sect_size):
+        """
+        Return a strided view over the loaded image data for as_array(), or None if the sectors are not placed at a constant interval in the same buffer.
+        """
+        if len(slots) == 0 or len(slots[0]) == 0 or sect_size == 0:
+            return None
+        base = None
+        for track_slots in slots:
+            for sect in track_slots:
+                if type(sect.sect_data) != memoryview:          # Modified sector or the image is not loaded in zero-copy mode
+                    return None
+                if base is None:
+                    base = sect.sect_data.obj
+                elif sect.sect_data.obj is not base:
+                    return None
+        base_array = np.frombuffer(base, dtype=np.uint8)
+        ofsts = np.array([ [ np.frombuffer(sect.sect_data, dtype=np.uint8).ctypes.data for sect in track_slots ] for track_slots in slots ], dtype=np.int64)
+        ofsts -= base_array.ctypes.data
+        num_tracks, num_sects = ofsts.shape
+        sect_stride = int(ofsts[0, 1] - ofsts[0, 0]) if num_sects > 1 else sect_size
+        track_stride = int(ofsts[1, 0] - ofsts[0, 0]) if num_tracks > 1 else num_sects * sect_stride
+        if sect_stride < sect_size or track_stride < num_sects * sect_stride:
+            return None
+        expected = ofsts[0, 0] + np.arange(num_tracks, dtype=np.int64)[:, None] * track_stride + np.arange(num_sects, dtype=np.int64)[None, :] * sect_stride
+        if not (ofsts == expected).all():
+            return None
+        return np.lib.stride_tricks.as_strided(base_array[ofsts[0, 0]:], shape=(num_tracks, num_sects, sect_size),
+                                               strides=(track_stride, sect_stride, 1), writeable=False)
+
+    def reconstruct_sector_header(self, sect) -> bytes:
         sect_hdr = struct.pack('<BBBBHBBB5xH', 
                                sect['C'],
                                sect['H'],
@@ -370,34 +1577,75 @@ class FLOPPY_DISK_D88:
                                sect['data_mark'],
                                sect['status'],
                                sect['data_size'])
-        sect_img = sect_hdr + sect['sect_data']
+        return sect_hdr
+
+    def reconstruct_sector_image(self, sect) -> bytes:
+        sect_img = self.reconstruct_sector_header(sect) + sect['sect_data']
         return sect_img 
 
-    def reconstruct_image_data(self):
-        """
-        Reconstruct single D88 disk image data from current contents of this object.
-        """
+    def reconstruct_track_image(self, track) -> bytes:
+        return b''.join([ self.reconstruct_sector_image(sect) for sect in self.tracks[track] ])
+
+    def reconstruct_d88_header(self, disk_size) -> bytes:
         disk_name = bytearray(self.disk_name)
         if len(disk_name) < 16:
-            disk_name += " " * (16-len(disk_name))
+            disk_name += b' ' * (16-len(disk_name))
         disk_name = disk_name[:16] + bytes([0])
-        d88_hdr = struct.pack(f'<17s9xBBI', disk_name, self.write_protect, self.disk_type, 0)
+        return struct.pack(f'<17s9xBBI', disk_name, self.write_protect, self.disk_type, disk_size)
 
-        all_track_img = bytearray()
-        track_table_img = bytearray()
-        size_of_d88_hdr = len(d88_hdr)
-        size_of_track_table = self.d88_max_track * 4
+    def calc_track_layout(self):
+        """
+        Return:
+          (track_table, disk_size). The track offsets from the top of the disk image, and the total disk image size.
+        """
+        track_table = [0] * self.d88_max_track
+        pos = 0x20 + self.d88_max_track * 4             # D88 header + track offset table
         for track in range(self.d88_max_track):
-            track_img = bytearray()
             if len(self.tracks[track]) > 0:
+                track_table[track] = pos
                 for sect in self.tracks[track]:
-                    sect_img = self.reconstruct_sector_image(sect)
-                    track_img += sect_img
-                track_table_img += struct.pack('<I', size_of_d88_hdr + size_of_track_table + len(all_track_img))
-            else:
-                track_table_img += struct.pack('<I', 0)
-            all_track_img += track_img
+                    pos += 0x10 + len(sect['sect_data'])
+        return track_table, pos
 
-        disk_image = bytearray( d88_hdr + track_table_img + all_track_img )
-        struct.pack_into('<I', disk_image, 0x1c, len(disk_image))               # Total disk image size
-        return disk_image
+    def write_image_data(self, f):
+        """
+        Write single D88 disk image data to a file object.  
+        The track offsets are calculated first, then the headers and the sector data are written in order without building the image in memory.
+        """
+        track_table, disk_size = self.calc_track_layout()
+        f.write(self.reconstruct_d88_header(disk_size))
+        f.write(struct.pack(f'<{self.d88_max_track}I', *track_table))
+        for track in range(self.d88_max_track):
+            for sect in self.tracks[track]:
+                f.write(self.reconstruct_sector_header(sect))
+                f.write(sect['sect_data'])
+        return disk_size
+
+    def reconstruct_image_data(self, buffer=None, ofst=0):
+        """
+        Reconstruct single D88 disk image data from current contents of this object.  
+        The image is filled into a preallocated bytearray. When buffer is given, the image is filled into buffer from ofst instead.
+        """
+        track_table, disk_size = self.calc_track_layout()
+        if buffer is None:
+            buffer = bytearray(disk_size)
+        buffer[ofst : ofst + 0x20] = self.reconstruct_d88_header(disk_size)
+        struct.pack_into(f'<{self.d88_max_track}I', buffer, ofst + 0x20, *track_table)
+        pos = ofst + 0x20 + self.d88_max_track * 4
+        for track in range(self.d88_max_track):
+            for sect in self.tracks[track]:
+                struct.pack_into('<BBBBHBBB5xH', buffer, pos,
+                                 sect['C'],
+                                 sect['H'],
+                                 sect['R'],
+                                 sect['N'],
+                                 sect['num_sectors'],
+                                 sect['density'],
+                                 sect['data_mark'],
+                                 sect['status'],
+                                 sect['data_size'])
+                pos += 0x10
+                data_size = len(sect['sect_data'])
+                buffer[pos : pos + data_size] = sect['sect_data']
+                pos += data_size
+        return buffer
@@ -0,0 +1,183 @@
+import struct
+
+from fdimagelib.floppy_image import *
+
+class DISK_PATCH:
+    """
+    Sector level difference between two FLOPPY_DISK_D88 objects. Created by diff_disk_images().  
+    Applying the patch to the source disk turns it into the target disk by replacing only the changed sectors.
+    """
+    OP_SET_META     = 0         # Disk name, write protect and disk type
+    OP_NUM_TRACKS   = 1         # Number of tracks (in track field)
+    OP_SET_HEADER   = 2         # Sector header of an existing sector
+    OP_SET_DATA     = 3         # Sector data of an existing sector
+    OP_TRUNCATE     = 4         # Remove the sectors from sect_idx to the end of the track
+    OP_APPEND       = 5         # Add a sector to the end of the track
+
+    magic = b'D88DIFF1'
+    op_format = '<BHH'                          # op, track, sect_idx
+    meta_format = '<17sBB'                      # disk name, write protect, disk type
+    sect_header_format = '<BBBBHBBBH'           # C, H, R, N, num_sectors, density, data_mark, status, data_size
+
+    def __init__(self):
+        self.ops = []                           # [ (op, track, sect_idx, header, data) ]
+
+    def is_empty(self) -> bool:
+        return len(self.ops) == 0
+
+    def add_op(self, op, track=0, sect_idx=0, header=None, data=None):
+        self.ops.append((op, track, sect_idx, header, data))
+
+    def apply(self, disk:FLOPPY_DISK_D88):
+        """
+        Apply the patch to a disk image. The changed tracks get new track lists and new sector objects, so the objects shared with other disk images are not modified.  
+            Input parameters:  
+            disk = Source disk image of the diff  
+        """
+        changed_tracks = {}
+        for op, track, sect_idx, header, data in self.ops:
+            match op:
+                case self.OP_SET_META:
+                    disk.set_meta_data(*header)
+                    continue
+                case self.OP_NUM_TRACKS:
+                    disk.set_num_tracks(track)
+                    changed_tracks = {}
+                    continue
+            if track not in changed_tracks:
+                if track >= len(disk.tracks):
+                    raise ValueError(f'Track {track} doesn\'t exist')
+                changed_tracks[track] = list(disk.tracks[track])
+            track_data = changed_tracks[track]
+            if op != self.OP_APPEND and sect_idx >= len(track_data):
+                raise ValueError(f'Sector {sect_idx} doesn\'t exist in track {track}')
+            match op:
+                case self.OP_SET_HEADER:
+                    sect = D88_SECTOR(sect_idx, *header, track_data[sect_idx].sect_data)
+                    track_data[sect_idx] = sect
+                case self.OP_SET_DATA:
+                    sect = track_data[sect_idx].copy()
+                    sect.sect_data = bytearray(data)
+                    track_data[sect_idx] = sect
+                case self.OP_TRUNCATE:
+                    del track_data[sect_idx:]
+                case self.OP_APPEND:
+                    track_data.append(D88_SECTOR(len(track_data), *header, bytearray(data)))
+                case _:
+                    raise ValueError(f'Unknown patch operation ({op})')
+            disk.replace_track(track, track_data)           # Kept for rollback() in a transaction
+
+    def encode(self) -> bytes:
+        res = [ self.magic, struct.pack('<I', len(self.ops)) ]
+        for op, track, sect_idx, header, data in self.ops:
+            res.append(struct.pack(self.op_format, op, track, sect_idx))
+            match op:
+                case self.OP_SET_META:
+                    res.append(struct.pack(self.meta_format, *header))
+                case self.OP_SET_HEADER:
+                    res.append(struct.pack(self.sect_header_format, *header))
+                case self.OP_SET_DATA:
+                    res.append(struct.pack('<I', len(data)))
+                    res.append(data)
+                case self.OP_APPEND:
+                    res.append(struct.pack(self.sect_header_format, *header))
+                    res.append(struct.pack('<I', len(data)))
+                    res.append(data)
+        return b''.join(res)
+
+    def decode(self, data:bytes):
+        if data[:len(self.magic)] != self.magic:
+            raise ValueError('Not a D88 patch data')
+        pos = len(self.magic)
+        num_ops = struct.unpack_from('<I', data, pos)[0]
+        pos += 4
+        self.ops = []
+        for _ in range(num_ops):
+            op, track, sect_idx = struct.unpack_from(self.op_format, data, pos)
+            pos += struct.calcsize(self.op_format)
+            header = None
+            sect_data = None
+            if op == self.OP_SET_META:
+                header = struct.unpack_from(self.meta_format, data, pos)
+                pos += struct.calcsize(self.meta_format)
+            if op in (self.OP_SET_HEADER, self.OP_APPEND):
+                header = struct.unpack_from(self.sect_header_format, data, pos)
+                pos += struct.calcsize(self.sect_header_format)
+            if op in (self.OP_SET_DATA, self.OP_APPEND):
+                size = struct.unpack_from('<I', data, pos)[0]
+                pos += 4
+                sect_data = bytes(data[pos : pos + size])
+                pos += size
+            self.ops.append((op, track, sect_idx, header, sect_data))
+
+    def write_file(self, file_name:str):
+        with open(file_name, 'wb') as f:
+            f.write(self.encode())
+
+    def read_file(self, file_name:str):
+        with open(file_name, 'rb') as f:
+            self.decode(f.read())
+
+
+def get_sector_header(sect:D88_SECTOR) -> tuple:
+    return (sect.C, sect.H, sect.R, sect.N, sect.num_sectors, sect.density, sect.data_mark, sect.status, sect.data_size)
+
+def is_same_data(data0, data1) -> bool:
+    if data0 is data1:
+        return True
+    if len(data0) != len(data1):
+        return False
+    if type(data0) == memoryview or type(data1) == memoryview:
+        return bytes(data0) == bytes(data1)     # memoryview is compared item by item. bytes comparison is much faster.
+    return data0 == data1
+
+def get_meta_data(disk:FLOPPY_DISK_D88):
+    if not hasattr(disk, 'disk_name'):
+        return None                             # Meta data is not set (e.g. deserialized disk image)
+    return (disk.disk_name, disk.write_protect, disk.disk_type)
+
+def diff_disk_images(src:FLOPPY_DISK_D88, dst:FLOPPY_DISK_D88) -> DISK_PATCH:
+    """
+    Compare two disk images track by track and sector by sector.  
+    Tracks and sectors shared by both disk images (same objects) are skipped without comparing the contents.  
+        Input parameters:  
+        src = Source disk image  
+        dst = Target disk image  
+    Return:
+      DISK_PATCH object which turns src into dst
+    """
+    patch = DISK_PATCH()
+    src_meta = get_meta_data(src)
+    dst_meta = get_meta_data(dst)
+    if dst_meta is not None and src_meta != dst_meta:
+        patch.add_op(DISK_PATCH.OP_SET_META, header=dst_meta)
+    src_tracks = src.tracks
+    dst_tracks = dst.tracks
+    if len(src_tracks) != len(dst_tracks):
+        patch.add_op(DISK_PATCH.OP_NUM_TRACKS, track=len(dst_tracks))
+    for track in range(len(dst_tracks)):
+        src_data = src.get_source_track_data(track)
+        if src_data is not None:
+            dst_data = dst.get_source_track_data(track)
+            if dst_data is not None and is_same_data(src_data, dst_data):
+                continue                        # Unmodified tracks with the same image data
+        dst_track = dst_tracks[track]
+        src_track = src_tracks[track] if track < len(src_tracks) else []
+        if src_track is dst_track:
+            continue
+        num_common = min(len(src_track), len(dst_track))
+        for sect_idx in range(num_common):
+            src_sect = src_track[sect_idx]
+            dst_sect = dst_track[sect_idx]
+            if src_sect is dst_sect:
+                continue
+            dst_header = get_sector_header(dst_sect)
+            if get_sector_header(src_sect) != dst_header:
+                patch.add_op(DISK_PATCH.OP_SET_HEADER, track, sect_idx, header=dst_header)
+            if not is_same_data(src_sect.sect_data, dst_sect.sect_data):
+                patch.add_op(DISK_PATCH.OP_SET_DATA, track, sect_idx, data=bytes(dst_sect.sect_data))
+        if len(src_track) > num_common:
+            patch.add_op(DISK_PATCH.OP_TRUNCATE, track, num_common)
+        for sect in dst_track[num_common:]:
+            patch.add_op(DISK_PATCH.OP_APPEND, track, sect.sect_idx, header=get_sector_header(sect), data=bytes(sect.sect_data))
+    return patch
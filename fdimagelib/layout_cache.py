@@ -0,0 +1,139 @@
+import os
+import struct
+import hashlib
+
+class LAYOUT_CACHE:
+    """
+    On-disk cache of the parsed layout of D88 image files.  
+    A cache entry keeps the disk image index, the track offset tables and the sector header arrays of an image file in a compact binary form.  
+    FLOPPY_IMAGE_D88.read_file() builds the disk images from the cache entry without scanning the image data.  
+    A cache entry is valid while the size and the mtime of the image file are unchanged.  
+    The total size of the cache files is bounded by max_size, and the least recently used entries are evicted.  
+    """
+    magic = b'D88LAYT1'
+    file_header_format = '<8sQQI'               # magic, file size, mtime (ns), number of images
+    image_header_format = '<Q17sBBI'            # offset, disk name, write protect, disk type, disk size
+    sect_header_format = '<BBBBHBBBH'           # C, H, R, N, num_sectors, density, data_mark, status, data_size
+    cache_file_ext = '.layout'
+
+    def __init__(self, cache_dir:str=None, max_size:int=64*1024*1024):
+        """
+            Input parameters:  
+            cache_dir = Directory to store the cache files (None: $FDIMAGELIB_CACHE_DIR or ~/.cache/fdimagelib)  
+            max_size = Maximum total size of the cache files in bytes  
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get('FDIMAGELIB_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'fdimagelib'))
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.d88_max_track = 164
+
+    def get_cache_file_name(self, file_name:str) -> str:
+        key = hashlib.sha1(os.path.abspath(file_name).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key + self.cache_file_ext)
+
+    def load(self, file_name:str, stat:os.stat_result):
+        """
+        Read the cache entry of an image file.  
+            Input parameters:  
+            file_name = D88/D77 image file name  
+            stat = os.stat() result of the image file  
+        Return:
+          Image index entries with 'layout':(track_table, track_ends, sect_headers). None if the cache entry doesn't exist or it is stale.
+        """
+        cache_file = self.get_cache_file_name(file_name)
+        try:
+            with open(cache_file, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            image_index = self.decode(data, stat)
+        except struct.error:
+            image_index = None                                  # Truncated cache file
+        if image_index is not None:
+            os.utime(cache_file)                                # Mark as recently used
+        return image_index
+
+    def store(self, file_name:str, stat:os.stat_result, image_index:list):
+        """
+        Write the cache entry of an image file, and evict the least recently used entries if the total size exceeds the limit.  
+            Input parameters:  
+            file_name = D88/D77 image file name  
+            stat = os.stat() result of the image file when the image data was read  
+            image_index = Image index entries with 'layout' (see load())  
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_file = self.get_cache_file_name(file_name)
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(self.encode(image_index, stat))
+        os.replace(tmp_file, cache_file)
+        self.evict()
+
+    def encode(self, image_index:list, stat:os.stat_result) -> bytes:
+        res = [ struct.pack(self.file_header_format, self.magic, stat.st_size, stat.st_mtime_ns, len(image_index)) ]
+        for index_entry in image_index:
+            track_table, track_ends, sect_headers = index_entry['layout']
+            res.append(struct.pack(self.image_header_format, index_entry['offset'], index_entry['disk_name'],
+                                   index_entry['write_protect'], index_entry['disk_type'], index_entry['disk_size']))
+            res.append(struct.pack(f'<{self.d88_max_track * 2}I', *track_table, *track_ends))
+            res.append(struct.pack(f'<{self.d88_max_track}H', *[ len(headers) for headers in sect_headers ]))
+            res.extend([ struct.pack(self.sect_header_format, *header) for headers in sect_headers for header in headers ])
+        return b''.join(res)
+
+    def decode(self, data:bytes, stat:os.stat_result):
+        magic, file_size, mtime_ns, num_images = struct.unpack_from(self.file_header_format, data, 0)
+        if magic != self.magic or file_size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+            return None
+        pos = struct.calcsize(self.file_header_format)
+        sect_header_size = struct.calcsize(self.sect_header_format)
+        image_index = []
+        for _ in range(num_images):
+            offset, disk_name, write_protect, disk_type, disk_size = struct.unpack_from(self.image_header_format, data, pos)
+            pos += struct.calcsize(self.image_header_format)
+            tables = struct.unpack_from(f'<{self.d88_max_track * 2}I', data, pos)
+            pos += self.d88_max_track * 2 * 4
+            sect_counts = struct.unpack_from(f'<{self.d88_max_track}H', data, pos)
+            pos += self.d88_max_track * 2
+            headers_size = sum(sect_counts) * sect_header_size
+            if pos + headers_size > len(data):
+                return None                                     # Truncated in the sector headers
+            headers = list(struct.iter_unpack(self.sect_header_format, data[pos : pos + headers_size]))
+            pos += headers_size
+            sect_headers = []
+            top = 0
+            for count in sect_counts:
+                sect_headers.append(headers[top : top + count])
+                top += count
+            image_index.append({ 'offset':offset, 'disk_name':disk_name, 'write_protect':write_protect, 'disk_type':disk_type, 'disk_size':disk_size,
+                                 'layout':(tables[:self.d88_max_track], list(tables[self.d88_max_track:]), sect_headers) })
+        if pos != len(data):
+            return None                                         # Truncated or trailing garbage
+        return image_index
+
+    def evict(self):
+        """
+        Remove the least recently used cache files until the total size fits in max_size.
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(self.cache_file_ext):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total_size = sum([ size for mtime, size, path in entries ])
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass                                            # Removed by another process
+            total_size -= size
+
+    def clear(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(self.cache_file_ext):
+                os.remove(entry.path)
@@ -1,7 +1,9 @@
 import typing
+import concurrent.futures
 
 from fdimagelib.ascii_j import *
 from fdimagelib.floppy_image import *
+from fdimagelib.layout_cache import *
 
 def dump_data(data:any):
     if type(data) != bytearray:
@@ -20,13 +22,15 @@ def dump_data(data:any):
         print('   ' * (16-(count % 16)))
         print(f'  {ascii_buf}')
 
-def open_image(file_name:str, image_number:str, verbose:bool=False) -> typing.Tuple[FLOPPY_IMAGE_D88, FLOPPY_DISK_D88]:
+def open_image(file_name:str, image_number:str, verbose:bool=False, lazy:bool=False, cache:LAYOUT_CACHE=None) -> typing.Tuple[FLOPPY_IMAGE_D88, FLOPPY_DISK_D88]:
+    """
+    Open an image file and return the specified disk image. file_name can be a compressed file or a zip archive member ('library.zip!/game.d88').  
+    The compressed image file is read up to the specified disk image.  
+    """
     if file_name == '':
         return
-    if os.path.exists(file_name) == False:
-        raise FileNotFoundError
     image_file = FLOPPY_IMAGE_D88()
-    image_file.read_file(file_name)
+    image_file.read_file(file_name, lazy=lazy, cache=cache, max_images=int(image_number) + 1)
 
     num_images = image_file.get_num_images()
     if verbose:
@@ -37,6 +41,39 @@ def open_image(file_name:str, image_number:str, verbose:bool=False) -> typing.Tu
     disk_image = image_file.images[image_number]
     return image_file, disk_image
 
+def _open_image_worker(file_name:str) -> FLOPPY_IMAGE_D88:
+    image_file = FLOPPY_IMAGE_D88()
+    image_file.read_file(file_name)
+    image_file.detach_image_data()          # Parse all disk images, and don't send the raw image data back
+    return image_file
+
+def _list_directory_worker(file_name:str) -> list:
+    from fdimagelib.file_system import FM_FILE_SYSTEM
+    image_file = FLOPPY_IMAGE_D88()
+    image_file.read_file(file_name, lazy=True)
+    fs = FM_FILE_SYSTEM()
+    listing = []
+    for disk_image in image_file.images:
+        fs.set_image(disk_image)
+        listing.append(fs.get_valid_directory_entries())
+    return listing
+
+def open_many(file_names:list, workers:int=None, listing:bool=False) -> list:
+    """
+    Open multiple image files in parallel with a process pool. The results are returned in the order of file_names.  
+        Input parameters:  
+        file_names = List of D88/D77 image file names  
+        workers = Number of worker processes (None: number of CPUs). The files are opened in this process when it's 1.  
+        listing = Return the valid directory entries of each disk image (list of lists) instead of FLOPPY_IMAGE_D88 objects.  
+    """
+    worker = _list_directory_worker if listing else _open_image_worker
+    if workers is not None and workers <= 1:
+        return [ worker(file_name) for file_name in file_names ]
+    num_workers = workers if workers is not None else os.cpu_count()
+    chunk_size = max(1, len(file_names) // (num_workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+        return list(executor.map(worker, file_names, chunksize=chunk_size))
+
 def attributes_to_string(file_type:int, ascii_flag:int, random_access_flag:int) -> typing.Tuple[str, str, str]:
     file_type_str = str(file_type) if file_type >=0 and file_type <= 2 else '?'
     ascii_flag_str = 'B' if ascii_flag == 0x00 else 'A' if ascii_flag == 0xff else '?'
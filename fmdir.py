@@ -4,7 +4,7 @@ import argparse
 import fdimagelib
 
 def main(args):
-    image_file, disk_image = fdimagelib.open_image(args.file, args.image_number)
+    image_file, disk_image = fdimagelib.open_image(args.file, args.image_number, lazy=True, cache=fdimagelib.LAYOUT_CACHE() if args.cache else None)
 
     fs = fdimagelib.FM_FILE_SYSTEM()
     fs.set_image(disk_image)
@@ -25,6 +25,7 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--file', required=True, help='D88/D77 image file name')
     parser.add_argument('-n', '--image_number', required=False, default=0, help='Specify target image number (if the image file contains multiple images). Default=0')
     parser.add_argument('--original', required=False, default=False, action='store_true', help='Display the original file name')
+    parser.add_argument('--cache', required=False, default=False, action='store_true', help='Use the parsed layout cache ($FDIMAGELIB_CACHE_DIR or ~/.cache/fdimagelib)')
     parser.add_argument('-v', '--verbose', required=False, default=False, action='store_true', help='Verbose flag')
     args = parser.parse_args()
     main(args)
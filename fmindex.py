@@ -0,0 +1,190 @@
+import os
+import io
+import time
+import hashlib
+import sqlite3
+import argparse
+import concurrent.futures
+
+import fdimagelib
+
+schema = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    hash TEXT,
+    num_images INTEGER
+);
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT,
+    image_number INTEGER,
+    offset INTEGER,
+    disk_name TEXT,
+    disk_type INTEGER,
+    write_protect INTEGER,
+    disk_size INTEGER,
+    PRIMARY KEY (path, image_number)
+);
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT,
+    image_number INTEGER,
+    dir_idx INTEGER,
+    file_name TEXT,
+    file_type INTEGER,
+    ascii_flag INTEGER,
+    random_access_flag INTEGER,
+    top_cluster INTEGER,
+    num_sectors INTEGER,
+    size INTEGER,
+    hash TEXT,
+    PRIMARY KEY (path, image_number, dir_idx)
+);
+CREATE INDEX IF NOT EXISTS entries_file_name ON entries (file_name);
+CREATE INDEX IF NOT EXISTS entries_hash ON entries (hash);
+"""
+
+def file_hash(file_name:str) -> str:
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if len(chunk) == 0:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def find_image_files(root:str):
+    if os.path.isfile(root):
+        yield os.path.abspath(root)
+        return
+    for dir_path, dir_names, file_names in os.walk(root):
+        for file_name in file_names:
+            if os.path.splitext(file_name)[1].upper() in ('.D88', '.D77'):
+                yield os.path.abspath(os.path.join(dir_path, file_name))
+
+def index_image_file(path:str):
+    """
+    Read an image file once, and index it. The file hash is calculated from the same data, so it always matches the indexed contents.  
+    Return:
+      ((size, mtime, hash) of the image file, image rows, directory entry rows)
+    """
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        image_data = f.read()
+    image_file = fdimagelib.FLOPPY_IMAGE_D88()
+    image_file.read_file(io.BytesIO(image_data), zero_copy=True)
+    fs = fdimagelib.FM_FILE_SYSTEM()
+    image_rows = []
+    entry_rows = []
+    for image_number, index_entry in enumerate(image_file.image_index):
+        disk_name = index_entry['disk_name'].split(b'\0')[0].decode(errors='replace').rstrip()
+        image_rows.append((path, image_number, index_entry['offset'], disk_name, index_entry['disk_type'], index_entry['write_protect'], index_entry['disk_size']))
+        fs.set_image(image_file.images[image_number])
+        try:
+            dir_entries = fs.get_valid_directory_entries()
+        except Exception:
+            continue                    # Not an F-BASIC disk
+        for dir_entry in dir_entries:
+            chain, last_secs = dir_entry.get_chain()
+            data = fs.read_cluster_chain(chain, last_secs)
+            entry_rows.append((path, image_number, dir_entry['dir_idx'], dir_entry['file_name_j'].rstrip(),
+                               dir_entry['file_type'], dir_entry['ascii_flag'], dir_entry['random_access_flag'],
+                               dir_entry['top_cluster'], dir_entry['num_sectors'], len(data), hashlib.sha1(data).hexdigest()))
+    return (stat.st_size, stat.st_mtime, hashlib.sha1(image_data).hexdigest()), image_rows, entry_rows
+
+def _index_worker(path:str):
+    try:
+        return index_image_file(path)
+    except Exception as e:
+        return e
+
+def update_catalog(db:sqlite3.Connection, roots:list, workers:int=1, verbose:bool=False):
+    """
+    Index the image files under roots. Image files whose size and mtime (or content hash) haven't changed are skipped.
+    The image files which failed to be indexed are not recorded, so they are tried again on the next scan.
+    Return:
+      (number of indexed files, number of skipped files, number of removed files)
+    """
+    stored = { path:(size, mtime, hash) for path, size, mtime, hash in db.execute('SELECT path, size, mtime, hash FROM files') }
+    found = set()
+    targets = []
+    num_skipped = 0
+    for root in roots:
+        for path in find_image_files(root):
+            found.add(path)
+            stat = os.stat(path)
+            if path in stored:
+                size, mtime, hash = stored[path]
+                if size == stat.st_size and mtime == stat.st_mtime:
+                    num_skipped += 1
+                    continue
+                if size == stat.st_size and hash == file_hash(path):
+                    db.execute('UPDATE files SET mtime=? WHERE path=?', (stat.st_mtime, path))     # Touched but not modified
+                    num_skipped += 1
+                    continue
+            targets.append((path, stat))
+
+    if workers > 1 and len(targets) > 1:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(_index_worker, [ path for path, stat in targets ]))
+    else:
+        results = [ _index_worker(path) for path, stat in targets ]
+
+    for (path, stat), result in zip(targets, results):
+        db.execute('DELETE FROM images WHERE path=?', (path,))
+        db.execute('DELETE FROM entries WHERE path=?', (path,))
+        if isinstance(result, Exception):
+            db.execute('DELETE FROM files WHERE path=?', (path,))
+            if verbose:
+                print(f'Failed to index {path} ({result!r})')
+            continue
+        (size, mtime, hash), image_rows, entry_rows = result
+        db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', (path, size, mtime, hash, len(image_rows)))
+        db.executemany('INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?)', image_rows)
+        db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', entry_rows)
+        if verbose:
+            print(f'Indexed {path} ({len(image_rows)} images, {len(entry_rows)} files)')
+
+    # Remove the image files which don't exist under the scanned directories anymore
+    abs_roots = [ os.path.abspath(root) for root in roots ]
+    removed = [ path for path in stored if path not in found and any([ path == root or path.startswith(os.path.join(root, '')) for root in abs_roots ]) ]
+    for path in removed:
+        db.execute('DELETE FROM files WHERE path=?', (path,))
+        db.execute('DELETE FROM images WHERE path=?', (path,))
+        db.execute('DELETE FROM entries WHERE path=?', (path,))
+    db.commit()
+    return len(targets), num_skipped, len(removed)
+
+def query_catalog(db:sqlite3.Connection, pattern:str):
+    """
+    Find files by name. pattern accepts '*' and '?' wildcards, and it is not case sensitive.
+    """
+    return db.execute('SELECT path, image_number, dir_idx, file_name, file_type, ascii_flag, random_access_flag, num_sectors, size, hash '
+                      'FROM entries WHERE upper(file_name) GLOB ? ORDER BY path, image_number, dir_idx', (pattern.upper(),)).fetchall()
+
+def main(args):
+    db = sqlite3.connect(args.database)
+    db.executescript(schema)
+    if args.scan is not None:
+        start = time.perf_counter()
+        num_indexed, num_skipped, num_removed = update_catalog(db, args.scan, int(args.workers), args.verbose)
+        if args.verbose:
+            print(f'{num_indexed} indexed, {num_skipped} skipped, {num_removed} removed ({time.perf_counter() - start:.2f} sec)')
+    if args.query is not None:
+        for path, image_number, dir_idx, file_name, file_type, ascii_flag, random_access_flag, num_sectors, size, hash in query_catalog(db, args.query):
+            attr_str = ''.join(fdimagelib.attributes_to_string(file_type, ascii_flag, random_access_flag))
+            print(f'{path} {image_number:2d} {dir_idx:3d} {file_name:8} {attr_str} {size:6d} {hash}')
+    db.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('fmindex', 'Build a catalog of D88/D77 image files and search files in it')
+    parser.add_argument('-d', '--database', required=False, default='fmindex.db', help='Catalog database file name. Default=fmindex.db')
+    parser.add_argument('-s', '--scan', required=False, nargs='+', help='Image files or directories to scan. Unchanged image files are skipped.')
+    parser.add_argument('-q', '--query', required=False, help='File name to search. \'*\' and \'?\' can be used as wildcards.')
+    parser.add_argument('-w', '--workers', required=False, default=1, help='Number of worker processes to index the image files. Default=1')
+    parser.add_argument('-v', '--verbose', required=False, default=False, action='store_true', help='Verbose flag')
+    args = parser.parse_args()
+    if args.scan is None and args.query is None:
+        parser.error('Either one of --scan or --query must be specified.')
+    main(args)
@@ -1,4 +1,6 @@
+import os
 import argparse
+import concurrent.futures
 
 import base64
 import yaml
@@ -6,24 +8,12 @@ import json
 
 import fdimagelib
 
-def main(args):
-    image_file, disk_image = fdimagelib.open_image(args.file, args.image_number)
-    fs = fdimagelib.FM_FILE_SYSTEM()
-    fs.set_image(disk_image)
-
-    if args.source != '' and args.source is not None:
-        if not fs.is_exist(args.source):
-            raise FileNotFoundError(f'Target file does not exist. ({args.source})')
-        data = fs.read_file(args.source)
-    elif args.index != '' and args.index is not None:
-        data = fs.read_file_by_idx(int(args.index))
-        if len(data['file_name']) == 0:
-            raise FileNotFoundError(f'Target file does not exist. (index=={args.index})')
-    else:
-        raise ValueError('Either one of --source or --index must be specified.')
-    if args.verbose:
-        print(f"Read file: {data['file_name_j']}")
-
+def convert_file(fs, data, args):
+    """
+    Convert a file read by FM_FILE_SYSTEM.read_file() according to the options.  
+    Return:
+      (contents to write, file extension)
+    """
     extracted_contents = fs.extract_file_contents(data['data'], data['file_type'], data['ascii_flag'])
     default_attr_str = ''.join(fdimagelib.attributes_to_string(data['file_type'], data['ascii_flag'], data['random_access_flag']))  # "2BS", "0BS", ...
 
@@ -104,6 +94,66 @@ def main(args):
         case 'json':
             write_contents = json.dumps(write_contents, indent=4)
             write_contents = write_contents.encode()
+    return write_contents, attr_str
+
+def sanitize_file_name(file_name:str) -> str:
+    """
+    Replace the characters which can't be used in a file name (path separators, control codes, etc) with '_'.
+    """
+    return ''.join([ '_' if ch in '/\\:*?"<>|' or ord(ch) < 0x20 else ch for ch in file_name ])
+
+def extract_all_files(fs, args):
+    """
+    Extract all files (or the files matching the pattern) at once. The conversions and the file writes run in a thread pool.  
+    The output file names are made unique before the files are written. A duplicated name gets the directory index as a suffix.
+    """
+    files = fs.extract_all(None if args.all == '*' else args.all)
+    destination_dir = args.destination if args.destination != '' and args.destination is not None else '.'
+    os.makedirs(destination_dir, exist_ok=True)
+
+    base_names = []
+    used_names = set()
+    for data in files:
+        base_name = sanitize_file_name(data['file_name_j'])
+        while base_name.upper() in used_names:              # Broken directories may have the same name twice
+            base_name = f"{base_name}_{data['dir_idx']}"
+        used_names.add(base_name.upper())
+        base_names.append(base_name)
+
+    def extract(data, base_name):
+        write_contents, attr_str = convert_file(fs, data, args)
+        destination_file = os.path.join(destination_dir, f'{base_name}.{attr_str}')
+        with open(destination_file, 'wb') as f:
+            f.write(write_contents)
+        return destination_file
+
+    with concurrent.futures.ThreadPoolExecutor(int(args.workers)) as executor:
+        for data, destination_file in zip(files, executor.map(extract, files, base_names)):
+            if args.verbose:
+                print(f"Read file: {data['file_name_j']} -> {destination_file}")
+
+def main(args):
+    image_file, disk_image = fdimagelib.open_image(args.file, args.image_number, lazy=True, cache=fdimagelib.LAYOUT_CACHE() if args.cache else None)
+    fs = fdimagelib.FM_FILE_SYSTEM()
+    fs.set_image(disk_image)
+
+    if args.all is not None:
+        extract_all_files(fs, args)
+        return
+    if args.source != '' and args.source is not None:
+        if not fs.is_exist(args.source):
+            raise FileNotFoundError(f'Target file does not exist. ({args.source})')
+        data = fs.read_file(args.source)
+    elif args.index != '' and args.index is not None:
+        data = fs.read_file_by_idx(int(args.index))
+        if len(data['file_name']) == 0:
+            raise FileNotFoundError(f'Target file does not exist. (index=={args.index})')
+    else:
+        raise ValueError('Either one of --source, --index or --all must be specified.')
+    if args.verbose:
+        print(f"Read file: {data['file_name_j']}")
+
+    write_contents, attr_str = convert_file(fs, data, args)
 
     if args.destination != '' and args.destination is not None:
         destination_file = f"{args.destination}.{attr_str}"
@@ -120,12 +170,15 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--image_number', required=False, default=0, help='Specify target image number (if the image file contains multiple images). Default=0')
     parser.add_argument('-s', '--source', required=False, help='Source file name in the image file to read.')
     parser.add_argument('-i', '--index', required=False, help='Directory index number to specify the target file to read.')
-    parser.add_argument('-d', '--destination', required=False, help='Destination (destination) file name. When omitted, the source file name and file attributes are used to generate the destination file name.')
+    parser.add_argument('-a', '--all', required=False, nargs='?', const='*', help='Read all files, or the files matching the pattern (\'*\' and \'?\' can be used as wildcards). The directory and the FAT are decoded once.')
+    parser.add_argument('-d', '--destination', required=False, help='Destination (destination) file name. When omitted, the source file name and file attributes are used to generate the destination file name. Destination directory with --all.')
+    parser.add_argument('-w', '--workers', required=False, default=4, help='Number of threads to convert and write the files with --all. Default=4')
     parser.add_argument('-v', '--verbose', required=False, default=False, action='store_true', help='Verbose flag')
     parser.add_argument('--decode_basic', required=False, action='store_true', default=False, help='Decode BASIC IR code and store it as a plain text file.')
     parser.add_argument('--srecord', required=False, action='store_true', default=False, help='Convert a machine code file contents to Motorola S-record format.')
     parser.add_argument('--yaml', required=False, action='store_true', default=False, help='Convert a machine code file contents to YAML format.')
     parser.add_argument('--json', required=False, action='store_true', default=False, help='Convert a machine code file contents to JSON format.<br>Note: The \'data\' will be encoded in base64.')
+    parser.add_argument('--cache', required=False, default=False, action='store_true', help='Use the parsed layout cache ($FDIMAGELIB_CACHE_DIR or ~/.cache/fdimagelib)')
     args = parser.parse_args()
 
     count = 0
@@ -6,6 +6,13 @@ import time
 import timeit
 
 import subprocess
+import importlib.util
+import pickle
+import hashlib
+import sqlite3
+import struct
+import pathlib
+import gzip, lzma, zipfile
 
 import fdimagelib
 
@@ -194,6 +201,803 @@ class TestDiskImage(unittest.TestCase):
                     fs.set_image(new_disk)
                     fs.dump_valid_directory()
 
+    def test_zero_copy_load(self):
+        test_file = 'zero_copy_test.d88'
+        new_image = create_new_image()
+        new_image.images[0].write_sector_LBA(2, bytearray(range(256)))
+        new_image.write_file(test_file)
+
+        image_file = fdimagelib.FLOPPY_IMAGE_D88()
+        image_file.read_file(test_file, zero_copy=True)
+        disk_image = image_file.images[0]
+        sect = disk_image.read_sector_LBA(2)
+        assert type(sect['sect_data']) == memoryview
+        assert sect['sect_data'] == bytearray(range(256))
+        disk_image.write_sector_LBA(2, bytearray(256))
+        assert type(disk_image.read_sector_LBA(2)['sect_data']) == bytearray
+        assert type(disk_image.read_sector_LBA(3)['sect_data']) == memoryview
+
+        image_file.reconstruct_image()
+        assert image_file.image_data[0x2b0 + 0x10 * 3 + 256 * 2 : 0x2b0 + 0x10 * 3 + 256 * 3] == bytearray(256)
+
+    def test_lazy_load(self):
+        test_file = 'lazy_test.d88'
+        new_image = create_new_image()
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(new_image.images[0])
+        fs.write_file('FILE1', bytearray([0x02 for _ in range(256 * 20)]), 0, 0, 0)
+        new_image.write_file(test_file)
+
+        image_file = fdimagelib.FLOPPY_IMAGE_D88()
+        image_file.read_file(test_file, lazy=True)
+        disk_image = image_file.images[0]
+        assert not disk_image.tracks.is_loaded(0)
+        fs.set_image(disk_image)
+        dirs = fs.get_valid_directory_entries()
+        assert len(dirs) == 1
+        assert disk_image.tracks.is_loaded(3) and not disk_image.tracks.is_loaded(10)
+
+        fs.write_file('FILE2', bytearray([0x03 for _ in range(256 * 20)]), 0, 0, 0)
+        image_file.write_file(test_file)            # Overwrite the mapped file
+        image_file = fdimagelib.FLOPPY_IMAGE_D88()
+        image_file.read_file(test_file, lazy=True)
+        fs.set_image(image_file.images[0])
+        assert fs.read_file('FILE1')['data'][:256 * 20] == bytearray([0x02 for _ in range(256 * 20)])
+        assert len(fs.get_valid_directory_entries()) == 2
+
+    def test_sector_object(self):
+        new_image = create_new_image()
+        new_disk = new_image.images[0]
+        sect = new_disk.read_sector(0, (0, 0, 3))
+        assert type(sect) == fdimagelib.D88_SECTOR
+        assert sect['R'] == sect.R == 3
+        assert sect['sect_data'][:3] == b'SYS'
+        assert set(sect.keys()) == { 'sect_idx', 'C', 'H', 'R', 'N', 'num_sectors', 'density', 'data_mark', 'status', 'data_size', 'sect_data' }
+        sect['status'] = 0x10
+        assert sect.status == 0x10
+        with self.assertRaises(KeyError):
+            sect['unknown'] = 0
+        assert sect.to_dict() == dict(sect.items())
+        assert sect.copy() == sect and sect.copy() is not sect
+
+    def test_sector_index(self):
+        new_image = create_new_image()
+        new_disk = new_image.images[0]
+        sect = new_disk.read_sector_LBA(2)
+        assert sect is new_disk.read_sector(0, (0, 0, 3)) and sect is new_disk.read_sector_LBA(2)
+        assert new_disk.read_sector(0, (1, 0, 3), ignoreCH=False) is None
+        assert new_disk.read_sector(0, (0, 0, 17)) is None
+
+        new_disk.write_sector(0, (0, 0, 17), bytearray(256), create_new=True)
+        sect = new_disk.read_sector(0, (0, 0, 17), ignoreCH=False)
+        assert sect is not None and sect['sect_idx'] == 16 and sect['num_sectors'] == 17
+
+        new_disk.tracks[4] = new_disk.create_new_track(0, 0)     # Modify the track list directly
+        new_disk.invalidate_sector_index(4)
+        assert new_disk.read_sector_LBA(4 * 16) is new_disk.tracks[4][0]
+
+        new_disk.read_sector_LBA(5 * 16)
+        new_disk.tracks[5] = new_disk.create_new_track(0, 0)     # Replaced without invalidate_sector_index()
+        assert new_disk.read_sector_LBA(5 * 16) is new_disk.tracks[5][0]
+        assert new_disk.read_sector_LBA(6 * 16 + 10) is not None
+        del new_disk.tracks[6][8:]
+        assert new_disk.read_sector_LBA(6 * 16 + 10) is None and new_disk.read_sector(6, (3, 0, 11)) is None
+
+    def test_incremental_write(self):
+        test_file = 'incremental_test.d88'
+        new_image = create_new_image()
+        new_image.create_and_add_new_empty_image()
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(new_image.images[1])
+        fs.logical_format()
+        new_image.write_file(test_file)
+        with open(test_file, 'rb') as f:
+            original_data = f.read()
+
+        image_file = fdimagelib.FLOPPY_IMAGE_D88()
+        image_file.read_file(test_file)
+        assert image_file.get_dirty_patches() == []
+        image_file.write_file(test_file)                    # Nothing changed
+        with open(test_file, 'rb') as f:
+            assert f.read() == original_data
+
+        fs.set_image(image_file.images[1])
+        fs.write_file('FILE1', bytearray([0x02 for _ in range(256 * 20)]), 0, 0, 0)
+        patches = image_file.get_dirty_patches()
+        assert sum([ len(data) for ofst, data in patches ]) < 0x1100 * 5
+        image_file.write_file(test_file)
+        with open(test_file, 'rb') as f:
+            patched_data = f.read()
+        image_file.reconstruct_image()
+        assert patched_data == image_file.image_data
+        assert image_file.images[1].dirty_tracks == set()
+
+        image_file.images[1].write_sector(0, (0, 0, 17), bytearray(256), create_new=True)
+        assert image_file.get_dirty_patches() is None       # The track size has been changed
+
+    def test_streaming_write(self):
+        test_file = 'streaming_test.d88'
+        new_image = create_new_image()
+        new_image.create_and_add_new_empty_image()
+        new_image.images[1].disk_name = b'SHORT'
+        new_image.write_file(test_file)
+        with open(test_file, 'rb') as f:
+            written_data = f.read()
+        new_image.reconstruct_image()
+        assert written_data == new_image.image_data
+        disk_size = len(new_image.images[0].reconstruct_image_data())
+        assert written_data[:disk_size] == new_image.images[0].reconstruct_image_data()
+        assert written_data[disk_size : disk_size + 17] == b'SHORT           \0'
+
+    def test_image_index(self):
+        test_file = 'image_index_test.d88'
+        new_image = create_new_image()
+        new_image.create_and_add_new_empty_image()
+        new_image.images[1].disk_name = b'SECOND'
+        new_image.write_file(test_file)
+
+        image_file = fdimagelib.FLOPPY_IMAGE_D88()
+        image_file.read_file(test_file)
+        assert image_file.get_num_images() == 2
+        assert not image_file.images.is_loaded(0) and not image_file.images.is_loaded(1)
+        assert image_file.image_index[1]['offset'] == image_file.image_index[0]['disk_size']
+        assert image_file.image_index[1]['disk_name'][:6] == b'SECOND'
+
+        image_file, disk_image = fdimagelib.open_image(test_file, '1')
+        assert not image_file.images.is_loaded(0) and image_file.images.is_loaded(1)
+        disk_image.write_sector_LBA(2, bytearray(256))
+        assert len(image_file.get_dirty_patches()) == 1
+        image_file.write_file(test_file)
+        assert not image_file.images.is_loaded(0)
+
+    def test_parallel_parse(self):
+        test_files = [ 'parallel_test0.d88', 'parallel_test1.d88' ]
+        for num, test_file in enumerate(test_files):
+            new_image = create_new_image()
+            new_image.create_and_add_new_empty_image()
+            fs = fdimagelib.FM_FILE_SYSTEM()
+            fs.set_image(new_image.images[1])
+            fs.logical_format()
+            fs.set_image(new_image.images[0])
+            fs.write_file(f'FILE{num}', bytearray([num for _ in range(256 * 20)]), 0, 0, 0)
+            new_image.write_file(test_file)
+
+        image_file = fdimagelib.FLOPPY_IMAGE_D88()
+        image_file.read_file(test_files[0], workers=2)
+        assert image_file.images.is_loaded(0) and image_file.images.is_loaded(1)
+        image_file.images[1].write_sector_LBA(2, bytearray(256))
+        assert len(image_file.get_dirty_patches()) == 1
+
+        image_files = fdimagelib.open_many(test_files, workers=2)
+        assert [ len(image_file.images) for image_file in image_files ] == [ 2, 2 ]
+        listings = fdimagelib.open_many(test_files, workers=2, listing=True)
+        assert [ listing[0][0]['file_name'] for listing in listings ] == [ b'FILE0   ', b'FILE1   ' ]
+        assert listings == fdimagelib.open_many(test_files, workers=1, listing=True)
+
+    def test_serialize_round_trip(self):
+        disk = create_new_image().images[0]
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(disk)
+        fs.write_file('ROUND', bytearray(range(256)) * 9 + bytearray(100), 2, 0, 0)
+        fs.write_file('TEXT', bytearray(b'10 PRINT "ROUND TRIP"\r\n\x1a'), 0, 0xff, 0)
+        disk.write_sector(40, (20, 0, 17), bytearray(range(128)), 0x40, 0x10, 0xb0, create_new=True)     # Irregular sector
+        track_images = lambda disk: [ disk.reconstruct_track_image(track) for track in range(len(disk.tracks)) ]
+        original = track_images(disk)
+        for file_name in [ 'round_trip.json', 'round_trip.yaml' ]:
+            for hex_dump in [ True, False ]:
+                disk.serialize(file_name, hex_dump=hex_dump)
+                assert track_images(disk) == original                   # serialize() must not modify the image
+                new_disk = fdimagelib.FLOPPY_DISK_D88()
+                new_disk.deserialize(file_name, hex_dump=hex_dump)
+                assert track_images(new_disk) == original
+
+    def test_layout_cache(self):
+        test_file = 'layout_cache_test.d88'
+        cache = fdimagelib.LAYOUT_CACHE('layout_cache_test', max_size=1024*1024)
+        cache.clear()
+        new_image = create_new_image()
+        new_image.create_and_add_new_empty_image()
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(new_image.images[0])
+        fs.write_file('CACHED', bytearray(range(256)) * 10, 2, 0, 0)
+        new_image.write_file(test_file)
+        track_images = lambda disk: [ disk.reconstruct_track_image(track) for track in range(len(disk.tracks)) ]
+
+        image_file = fdimagelib.FLOPPY_IMAGE_D88()
+        image_file.read_file(test_file, cache=cache)                    # Cache miss. The layout is stored.
+        assert os.path.exists(cache.get_cache_file_name(test_file))
+        for lazy in [ False, True ]:
+            cached_file = fdimagelib.FLOPPY_IMAGE_D88()
+            cached_file.parse_image = None                              # Must not be called on a cache hit
+            cached_file.read_file(test_file, lazy=lazy, cache=cache)
+            assert len(cached_file.images) == 2
+            for disk, cached_disk in zip(image_file.images, cached_file.images):
+                assert track_images(disk) == track_images(cached_disk)
+                assert cached_disk.source_layout == disk.source_layout
+            fs.set_image(cached_file.images[0])
+            assert fs.read_file('CACHED')['data'][:2560] == bytearray(range(256)) * 10
+
+        image_file.images[0].write_sector_LBA(2, bytearray(256))
+        image_file.write_file(test_file)
+        stale_file = fdimagelib.FLOPPY_IMAGE_D88()
+        stale_file.read_file(test_file, cache=cache)                    # Stale entry (mtime changed)
+        assert stale_file.images[0].read_sector_LBA(2)['sect_data'] == bytearray(256)
+        stat = os.stat(test_file)
+        with open(cache.get_cache_file_name(test_file), 'rb') as f:
+            cache_data = f.read()
+        assert cache.decode(cache_data, stat) is not None
+        sect_header_size = struct.calcsize(cache.sect_header_format)
+        for size in [ len(cache_data) - sect_header_size, len(cache_data) - 1, len(cache_data) + 1 ]:     # Truncated or padded cache entry
+            assert cache.decode((cache_data + bytes(1))[:size], stat) is None
+        with open(cache.get_cache_file_name(test_file), 'wb') as f:
+            f.write(cache_data[:-sect_header_size])
+        assert cache.load(test_file, stat) is None
+
+        small_cache = fdimagelib.LAYOUT_CACHE('layout_cache_test', max_size=0)
+        small_cache.evict()
+        assert len(os.listdir('layout_cache_test')) == 0
+
+    def test_sector_range_read(self):
+        new_image = create_new_image()
+        disk = new_image.images[0]
+        for LBA in range(64, 64 + 16):
+            disk.write_sector_LBA(LBA, bytearray([LBA for _ in range(256)]))
+        expected = b''.join([ bytes([LBA for _ in range(256)]) for LBA in range(64, 64 + 16) ])
+        assert disk.read_sectors_LBA(64, 16) == expected                  # Whole track
+        assert disk.read_sectors_LBA(64, 8) == expected[:256 * 8]         # Cluster
+        single = disk.read_sectors_LBA(65, 1)
+        assert single.readonly and single == expected[256:512]
+        buffer = bytearray(256 * 20)
+        assert disk.readinto_sectors_LBA(66, 4, buffer) == 256 * 4
+        assert buffer[:256 * 4] == expected[512:512 + 256 * 4]
+        with self.assertRaises(ValueError):
+            disk.readinto_sectors_LBA(64, 4, bytearray(256 * 3))
+        with self.assertRaises(ValueError):
+            disk.read_sectors_LBA(164 * 16, 2)
+
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(disk)
+        file_data = bytearray(range(256)) * 19 + bytearray(100)
+        fs.write_file('RANGE', file_data, 2, 0, 0)
+        assert fs.read_file('RANGE')['data'][:len(file_data)] == file_data
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), 'NumPy is not installed')
+    def test_as_array(self):
+        test_file = 'as_array_test.d88'
+        new_image = create_new_image()
+        new_image.images[0].write_sector_LBA(4 * 16 + 2, bytearray([0x5a for _ in range(256)]))
+        new_image.write_file(test_file)
+
+        image_file = fdimagelib.FLOPPY_IMAGE_D88()
+        image_file.read_file(test_file, lazy=True)
+        data, mask, headers = image_file.images[0].as_array()
+        assert data.shape == (80, 16, 256) and mask.all()
+        assert data.base is not None and not data.flags.writeable          # View over the memory-mapped image
+        assert (data[4, 2] == 0x5a).all()
+        assert (headers['R'][:, 0] == 1).all() and (headers['C'][5] == 2).all() and (headers['H'][5] == 1).all()
+
+        copied_file = fdimagelib.FLOPPY_IMAGE_D88()
+        copied_file.read_file(test_file)
+        copied_disk = copied_file.images[0]
+        del copied_disk.tracks[7][3]
+        copied_disk.invalidate_sector_index(7)
+        copied_data, copied_mask, copied_headers = copied_disk.as_array()
+        assert copied_data.flags.writeable and not copied_mask[7, 3] and copied_mask.sum() == 80 * 16 - 1
+        assert (copied_data[7, 3] == 0).all()
+        assert (copied_data[copied_mask] == data[copied_mask]).all()
+        assert (copied_headers[copied_mask] == headers[copied_mask]).all()
+
+    def test_image_diff(self):
+        test_file = 'diff_test.d88'
+        create_new_image().write_file(test_file)
+        src_file = fdimagelib.FLOPPY_IMAGE_D88()
+        src_file.read_file(test_file, zero_copy=True)
+        dst_file = fdimagelib.FLOPPY_IMAGE_D88()
+        dst_file.read_file(test_file, zero_copy=True)
+        src = src_file.images[0]
+        dst = dst_file.images[0]
+        assert fdimagelib.diff_disk_images(src, dst).is_empty()
+
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(dst)
+        fs.write_file('DIFF', bytearray(range(256)) * 12, 2, 0, 0)
+        dst.write_protect = 0x10
+        dst.tracks[10][15]['status'] = 0xb0
+        dst.mark_dirty(10)
+        del dst.tracks[11][8:]
+        dst.mark_dirty(11)
+        dst.write_sector(12, (6, 0, 17), bytearray(128), create_new=True)
+        patch = fdimagelib.diff_disk_images(src, dst)
+        assert not patch.is_empty()
+        patch.write_file('diff_test.patch')
+
+        loaded_patch = fdimagelib.DISK_PATCH()
+        loaded_patch.read_file('diff_test.patch')
+        assert loaded_patch.ops == patch.ops
+        target_file = fdimagelib.FLOPPY_IMAGE_D88()
+        target_file.read_file(test_file)
+        target = target_file.images[0]
+        target.begin()
+        loaded_patch.apply(target)
+        target.rollback()
+        assert fdimagelib.diff_disk_images(src, target).is_empty()
+        assert target.read_sector(12, (6, 0, 17)) is None
+        loaded_patch.apply(target)
+        assert fdimagelib.diff_disk_images(target, dst).is_empty()
+        assert target.reconstruct_image_data() == dst.reconstruct_image_data()
+        assert fdimagelib.diff_disk_images(src, src_file.images[0]).is_empty()     # Source image is not modified
+
+    def test_transaction(self):
+        new_image = create_new_image()
+        disk = new_image.images[0]
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(disk)
+        fs.write_file('FIRST', bytearray(range(256)) * 4, 2, 0, 0)
+        original = disk.reconstruct_image_data()
+
+        disk.begin()
+        fs.write_file('SECOND', bytearray(256 * 4), 2, 0, 0)
+        assert fs.is_exist('SECOND')
+        assert len(disk._transactions[-1]['tracks']) < 4               # Only the touched tracks are copied
+        disk.rollback()
+        assert not fs.is_exist('SECOND') and fs.is_exist('FIRST')
+        assert disk.reconstruct_image_data() == original
+
+        with self.assertRaises(AssertionError):                         # Disk full. The failed write is rolled back.
+            fs.write_file('HUGE', bytearray(256 * 8 * 160), 2, 0, 0)
+        assert disk.reconstruct_image_data() == original
+
+        with disk.transaction():
+            fs.write_file('THIRD', bytearray(256), 2, 0, 0)
+            disk.begin()
+            fs.delete_file('FIRST')
+            disk.rollback()
+        assert fs.is_exist('THIRD') and fs.is_exist('FIRST')
+        with self.assertRaises(ValueError):
+            disk.commit()
+
+        snapshot = disk.snapshot()
+        snapshot_image = snapshot.reconstruct_image_data()
+        assert snapshot.tracks[40] is disk.tracks[40]
+        fs.write_file('FOURTH', bytearray(256), 2, 0, 0)
+        assert snapshot.reconstruct_image_data() == snapshot_image      # The snapshot doesn't see the change
+        fs_snapshot = fdimagelib.FM_FILE_SYSTEM()
+        fs_snapshot.set_image(snapshot)
+        fs_snapshot.delete_file('FIRST')
+        assert fs.is_exist('FIRST') and not fs_snapshot.is_exist('FIRST') and not fs_snapshot.is_exist('FOURTH')
+        assert snapshot.tracks[40] is disk.tracks[40]
+
+    def test_crash_safe_write(self):
+        test_file = 'crash_safe_test.d88'
+        create_new_image().write_file(test_file)
+        with open(test_file, 'rb') as f:
+            original = f.read()
+
+        image_file = fdimagelib.FLOPPY_IMAGE_D88()
+        image_file.read_file(test_file)
+        image_file.create_and_add_new_empty_image()                   # Requires a full write
+        def interrupted_write(f):
+            f.write(b'broken')
+            raise KeyboardInterrupt
+        image_file.images[1].write_image_data = interrupted_write
+        with self.assertRaises(KeyboardInterrupt):
+            image_file.write_file(test_file)
+        with open(test_file, 'rb') as f:
+            assert f.read() == original
+        assert [ name for name in os.listdir('.') if name.startswith(test_file + '.') ] == []
+
+        image_file = fdimagelib.FLOPPY_IMAGE_D88()
+        image_file.read_file(test_file)
+        image_file.images[0].write_sector_LBA(2, bytearray(b'JOURNAL' * 36 + b'....'))
+        patches = image_file.get_dirty_patches()
+        journal_file = image_file.get_journal_file_name(test_file)
+        image_file.write_journal(journal_file, patches)              # Crashed after writing the journal
+        replayed = fdimagelib.FLOPPY_IMAGE_D88()
+        replayed.read_file(test_file)
+        assert not os.path.exists(journal_file)
+        assert replayed.images[0].read_sector_LBA(2)['sect_data'][:7] == b'JOURNAL'
+
+        replayed.images[0].write_sector_LBA(2, bytearray(256))
+        replayed.write_journal(journal_file, replayed.get_dirty_patches())
+        with open(journal_file, 'r+b') as f:
+            f.truncate(os.path.getsize(journal_file) - 10)             # Crashed while writing the journal
+        discarded = fdimagelib.FLOPPY_IMAGE_D88()
+        discarded.read_file(test_file)
+        assert not os.path.exists(journal_file)
+        assert discarded.images[0].read_sector_LBA(2)['sect_data'][:7] == b'JOURNAL'
+
+        discarded.images[0].write_sector_LBA(2, bytearray(256))
+        discarded.write_file(test_file)                               # In place through the journal
+        assert not os.path.exists(journal_file)
+        check = fdimagelib.FLOPPY_IMAGE_D88()
+        check.read_file(test_file)
+        assert check.images[0].read_sector_LBA(2)['sect_data'] == bytearray(256)
+
+        other = fdimagelib.FLOPPY_IMAGE_D88()
+        other.read_file(test_file)
+        other.images[0].write_sector(0, (0, 0, 17), bytearray(256), create_new=True)
+        other.write_file(test_file)                                   # Track layout changed by another writer
+        check.images[0].write_sector_LBA(5 * 16, bytearray(b'STALE' * 51 + b'.'))
+        assert check.get_dirty_patches() is not None
+        check.write_file(test_file)                                   # Must not patch the offsets of the old layout
+        check.reconstruct_image()
+        with open(test_file, 'rb') as f:
+            assert f.read() == check.image_data
+        assert check.is_source_unchanged(os.stat(test_file))           # The next write goes in place again
+
+        if os.path.isdir('/proc/self/fd'):                                 # Windows can't replace a file which is still open
+            floppy_image = sys.modules['fdimagelib.floppy_image']
+            fcntl, replace = floppy_image.fcntl, os.replace
+            def checked_replace(src, dst):
+                open_files = [ os.path.realpath(os.path.join('/proc/self/fd', fd)) for fd in os.listdir('/proc/self/fd') ]
+                assert os.path.realpath(dst) not in open_files
+                replace(src, dst)
+            try:
+                floppy_image.fcntl, os.replace = None, checked_replace
+                check.images[0].write_sector(0, (0, 0, 18), bytearray(256), create_new=True)
+                check.write_file(test_file)
+            finally:
+                floppy_image.fcntl, os.replace = fcntl, replace
+            check.reconstruct_image()
+            with open(test_file, 'rb') as f:
+                assert f.read() == check.image_data
+
+    def test_compressed_source(self):
+        test_file = 'compressed_test.d88'
+        new_image = create_new_image()
+        new_image.create_and_add_new_empty_image()
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(new_image.images[0])
+        fs.write_file('PACKED', bytearray(range(256)) * 3, 2, 0, 0)
+        new_image.write_file(test_file)
+        with open(test_file, 'rb') as f:
+            image_data = f.read()
+        with gzip.open(test_file + '.gz', 'wb') as f:
+            f.write(image_data)
+        with lzma.open(test_file + '.xz', 'wb') as f:
+            f.write(image_data)
+        with zipfile.ZipFile('compressed_test.zip', 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('disks/game.d88', image_data)
+            archive.writestr('game.d88.gz', gzip.compress(image_data))
+
+        sources = [ test_file + '.gz', test_file + '.xz', 'compressed_test.zip!/disks/game.d88', 'compressed_test.zip!game.d88.gz' ]
+        for source in sources:
+            for lazy in [ False, True ]:
+                image_file = fdimagelib.FLOPPY_IMAGE_D88()
+                image_file.read_file(source, lazy=lazy)
+                assert image_file.get_num_images() == 2
+                image_file.reconstruct_image()
+                assert image_file.image_data == image_data
+        with open(test_file, 'rb') as f:
+            image_file = fdimagelib.FLOPPY_IMAGE_D88()
+            image_file.read_file(f, max_images=1)                     # Stops reading after the first disk image
+            assert image_file.get_num_images() == 1 and f.tell() == image_file.image_index[0]['disk_size']
+        for source in [ pathlib.Path(test_file), pathlib.Path(test_file + '.gz') ]:
+            image_file = fdimagelib.FLOPPY_IMAGE_D88()
+            image_file.read_file(source)
+            assert image_file.get_num_images() == 2
+        image_file.write_file(pathlib.Path(test_file))
+
+        image_file, disk_image = fdimagelib.open_image('compressed_test.zip!/disks/game.d88', 0)
+        fs.set_image(disk_image)
+        assert fs.read_file('PACKED')['data'][:256 * 3] == bytearray(range(256)) * 3
+        with self.assertRaises(FileNotFoundError):
+            fdimagelib.open_image('compressed_test.zip!/missing.d88', 0)
+        res = subprocess.run(f'python fmdir.py -f compressed_test.zip!/disks/game.d88', shell=True, check=True, capture_output=True, text=True)
+        assert 'PACKED' in res.stdout
+
+    def test_flat_image(self):
+        new_image = create_new_image()
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(new_image.images[0])
+        fs.write_file('D88FILE', bytearray(range(256)) * 2, 2, 0, 0)
+
+        flat = fdimagelib.FLAT_DISK_IMAGE()
+        flat.from_d88(new_image.images[0], 80)
+        assert len(flat.image_data) == 80 * 16 * 256
+        fs.set_image(flat)
+        assert fs.read_file('D88FILE')['data'][:512] == bytearray(range(256)) * 2
+        FAT = fs._read_FAT()
+        assert fs._read_FAT() is FAT and fs.get_number_of_free_clusters() == 152 - 1     # The FAT cache is kept on a flat image
+        fs.write_file('FLATFILE', bytearray(range(256)) * 20, 2, 0, 0)
+        assert flat.read_sector_LBA(35)['sect_data'] == flat.image_data[35 * 256 : 36 * 256]
+        assert flat.read_sectors_LBA(32, 3) == flat.image_data[32 * 256 : 35 * 256]
+        flat.write_file('flat_test.2d')
+        with self.assertRaises(ValueError):
+            flat.write_sector_LBA(40, bytearray(257))
+
+        for use_mmap in [ False, True ]:
+            flat2 = fdimagelib.FLAT_DISK_IMAGE()
+            flat2.read_file('flat_test.2d', use_mmap=use_mmap)
+            assert flat2.num_tracks == 80
+            fs.set_image(flat2)
+            assert fs.read_file('FLATFILE')['data'][:256 * 20] == bytearray(range(256)) * 20
+            with flat2.transaction():
+                fs.write_file('MAPPED', bytearray(256), 2, 0, 0)
+            flat2.begin()
+            fs.delete_file('FLATFILE')
+            flat2.rollback()
+            assert fs.is_exist('FLATFILE') and fs.is_exist('MAPPED')
+        flat2.write_file('flat_test.2d')                                # Replaces the mapped file
+
+        disk = flat.to_d88()
+        fs.set_image(disk)
+        assert fs.read_file('FLATFILE')['data'][:256 * 20] == bytearray(range(256)) * 20
+        flat3 = fdimagelib.FLAT_DISK_IMAGE()
+        flat3.from_d88(disk)
+        assert flat3.image_data == flat.image_data
+
+    def test_batch_sector_write(self):
+        new_image = fdimagelib.FLOPPY_IMAGE_D88()
+        new_image.create_and_add_new_empty_image()
+        disk = new_image.images[0]
+        snapshot = disk.snapshot()
+        disk.write_sectors([ (0, (0, 0, R), bytearray([R]) * 256) for R in range(1, 17) ] +
+                           [ (1, (0, 1, R), bytearray([R]) * 128, 0x40, 0x10, 0x00) for R in range(17, 33) ])
+        assert len(disk.tracks[0]) == 16 and len(disk.tracks[1]) == 32
+        assert [ sect['sect_idx'] for sect in disk.tracks[1] ] == list(range(32))
+        assert all([ sect['num_sectors'] == 32 for sect in disk.tracks[1] ])
+        sect = disk.read_sector(1, (0, 1, 20))
+        assert sect['N'] == 0 and sect['density'] == 0x40 and sect['sect_data'] == bytearray([20]) * 128
+        assert disk.read_sector(0, (0, 0, 5))['sect_data'] == bytearray([5]) * 256
+        assert snapshot.read_sector(0, (0, 0, 5))['sect_data'] == bytearray(256)       # Copy-on-write
+        with self.assertRaises(ValueError):
+            disk.write_sectors([ (2, (1, 0, 1), bytearray(300)) ])
+        dirty_tracks = set(disk.dirty_tracks)
+        with self.assertRaises(ValueError):
+            disk.write_sectors([ (0, (0, 0, 1), bytearray(256)), (0, (0, 0, 17), bytearray(256)), (2, (1, 0, 1), bytearray(300)) ])
+        assert len(disk.tracks[0]) == 16 and disk.read_sector(0, (0, 0, 1))['sect_data'] == bytearray([1]) * 256
+        assert disk.dirty_tracks == dirty_tracks
+        with self.assertWarns(UserWarning):
+            disk.write_sector(2, (1, 0, 1), bytearray(200))
+        assert len(disk.read_sector(2, (1, 0, 1))['sect_data']) == 256
+
+        interleaved = [ ((2, 0, R), bytearray([R]) * 512) for R in (1, 4, 7, 2, 5, 8, 3, 6, 9) ]
+        disk.begin()
+        disk.write_track(4, interleaved)
+        assert [ sect['R'] for sect in disk.tracks[4] ] == [ 1, 4, 7, 2, 5, 8, 3, 6, 9 ]
+        assert disk.read_sector(4, (2, 0, 8))['sect_data'] == bytearray([8]) * 512 and disk.tracks[4][0]['N'] == 2
+        disk.rollback()
+        assert len(disk.tracks[4]) == 16
+        disk.write_track(4, interleaved)
+        new_image.write_file('batch_test.d88')
+        image_file = fdimagelib.FLOPPY_IMAGE_D88()
+        image_file.read_file('batch_test.d88')
+        assert [ sect['R'] for sect in image_file.images[0].tracks[4] ] == [ 1, 4, 7, 2, 5, 8, 3, 6, 9 ]
+
+    def test_track_cache_budget(self):
+        test_file = 'budget_test.d88'
+        new_image = create_new_image()
+        for _ in range(2):
+            new_image.create_and_add_new_empty_image()
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        for image_number in range(3):
+            fs.set_image(new_image.images[image_number])
+            fs.logical_format()
+            fs.write_file('DATA', bytearray([image_number]) * 256 * 100, 2, 0, 0)
+        new_image.write_file(test_file)
+
+        image_file = fdimagelib.FLOPPY_IMAGE_D88()
+        image_file.read_file(test_file, max_cached_tracks=8)
+        assert image_file.lazy
+        def num_loaded_tracks():
+            return sum([ sum([ image_file.images[n].tracks.is_loaded(track) for track in range(164) ]) for n in range(3) ])
+        for _ in range(2):
+            for image_number in range(3):
+                fs.set_image(image_file.images[image_number])
+                assert fs.read_file('DATA')['data'][:256 * 100] == bytearray([image_number]) * 256 * 100
+                assert num_loaded_tracks() <= 8
+
+        disk = image_file.images[0]
+        disk.write_sector_LBA(16 * 40, bytearray([0xaa]) * 256)      # Track 40 is dirty. It must survive the eviction.
+        for image_number in range(3):
+            fs.set_image(image_file.images[image_number])
+            fs.read_file('DATA')
+        assert disk.tracks.is_loaded(40) and disk.read_sector_LBA(16 * 40)['sect_data'] == bytearray([0xaa]) * 256
+        image_file.write_file(test_file)                                # In-place update
+        assert len(disk.dirty_tracks) == 0
+
+        fs.set_image(image_file.images[1])
+        fs.read_file('DATA')
+        check_file = fdimagelib.FLOPPY_IMAGE_D88()
+        check_file.read_file(test_file)
+        assert check_file.images[0].read_sector_LBA(16 * 40)['sect_data'] == bytearray([0xaa]) * 256
+        assert disk.read_sector_LBA(16 * 40)['sect_data'] == bytearray([0xaa]) * 256
+
+        def read_all_files():
+            for image_number in range(3):
+                fs.set_image(image_file.images[image_number])
+                assert fs.read_file('DATA')['data'][:256 * 100] == bytearray([image_number]) * 256 * 100
+                assert fs.read_file('DATA2')['data'][:256 * 20] == bytearray([0x55 + image_number]) * 256 * 20
+        for image_number in range(3):                                   # The tracks copied in the transactions are replaced ones
+            fs.set_image(image_file.images[image_number])
+            fs.write_file('DATA2', bytearray([0x55 + image_number]) * 256 * 20, 2, 0, 0)
+            fs.write_file('TEMP', bytearray(256 * 10), 2, 0, 0)
+            fs.delete_file('TEMP')
+        image_file.write_file(test_file)                                # In-place update
+        read_all_files()
+        read_all_files()
+        assert num_loaded_tracks() <= 8
+
+        image_file.create_and_add_new_empty_image()
+        image_file.write_file(test_file)                                # Full rewrite. The tracks are parsed from the new file.
+        assert image_file.lazy
+        read_all_files()
+        assert num_loaded_tracks() <= 8
+        check_file = fdimagelib.FLOPPY_IMAGE_D88()
+        check_file.read_file(test_file)
+        assert len(check_file.images) == 4
+        with self.assertRaises(ValueError):
+            fdimagelib.LRU_BUDGET(0)
+
+    def test_FAT_cache(self):
+        new_image = create_new_image()
+        disk = new_image.images[0]
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(disk)
+        FAT = fs._read_FAT()
+        assert fs._read_FAT() is FAT                                    # Not read again while the FAT sector is unchanged
+        fs.read_FAT()[5:10] = bytes(5)                                  # read_FAT() returns a copy
+        assert fs._read_FAT() is FAT and FAT[5:10] == bytes([0xff]) * 5
+        fs.write_file('FILE1', bytearray(256 * 20), 2, 0, 0)
+        assert not fs.FAT_dirty and disk.read_sector(2, (1, 0, 1))['sect_data'] == fs.read_FAT()
+        fs.get_valid_directory_entries()
+        assert fs._read_FAT() is fs.FAT
+
+        FAT = fs.read_FAT()
+        FAT[5 + 100] = 0xfe
+        fs.write_FAT(FAT)                                               # Written immediately out of an operation
+        assert disk.read_sector(2, (1, 0, 1))['sect_data'] == FAT and not fs.FAT_dirty
+        with fs.operation():
+            fs.write_FAT(bytearray([0x00] + [0xff] * 255))              # Written back at the end of the operation
+            assert disk.read_sector(2, (1, 0, 1))['sect_data'] == FAT
+            fs.discard_FAT()
+        assert fs.get_number_of_free_clusters() == 152 - 4
+        fs.set_FAT_entry(100, 0xff)
+        fs.flush()
+        assert fs.get_number_of_free_clusters() == 152 - 3
+
+        disk.begin()
+        fs.write_file('FILE2', bytearray(256 * 20), 2, 0, 0)
+        disk.rollback()                                                 # The cached FAT follows the rolled back FAT sector
+        assert fs.get_number_of_free_clusters() == 152 - 3
+        other_fs = fdimagelib.FM_FILE_SYSTEM()
+        other_fs.set_image(disk)
+        other_fs.delete_file('FILE1')
+        assert fs.get_number_of_free_clusters() == 152
+
+        fs.write_file('EXACT', bytearray(256 * 15), 2, 0, 0)            # Padded to 2 clusters exactly
+        assert fs.is_exist('EXACT') and fs.get_directory_entry('EXACT')['num_sectors'] == 16
+
+    def test_cluster_allocator(self):
+        new_image = create_new_image()
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(new_image.images[0])
+        cluster_size = 256 * 8
+        for file_name, num_clusters in [ ('A', 2), ('B', 1), ('C', 2), ('D', 3), ('E', 1) ]:
+            fs.write_file(file_name, bytearray(cluster_size * num_clusters - 256), 2, 0, 0)
+        fs.delete_file('B')                                             # Holes: cluster 2 (1 cluster), clusters 5-7 (3 clusters)
+        fs.delete_file('D')
+        assert fs.find_free_runs()[:2] == [ (2, 1), (5, 3) ]
+        num_free = fs.get_number_of_free_clusters()
+        assert num_free == sum([ fs.read_FAT()[cluster + 5] == 0xff for cluster in range(152) ])
+
+        fs.write_file('F', bytearray(cluster_size * 3 - 256), 2, 0, 0)   # Best fit. Not the first hole.
+        assert fs.trace_FAT_chain(fs.get_directory_entry('F')['top_cluster'])[0] == [ 5, 6, 7 ]
+        fs.write_file('G', bytearray(cluster_size - 256), 2, 0, 0)
+        assert fs.get_directory_entry('G')['top_cluster'] == 2
+        assert fs.get_number_of_free_clusters() == num_free - 4
+
+        fs.delete_file('A')                                             # Holes: clusters 0-1, cluster 8 and later
+        fs.delete_file('E')
+        data = bytearray(range(256)) * 8 * 150
+        fs.write_file('BIG', data[:cluster_size * 146 - 256], 2, 0, 0)  # Doesn't fit in a run. The largest run is used first.
+        chain, last_secs = fs.trace_FAT_chain(fs.get_directory_entry('BIG')['top_cluster'])
+        assert chain[:2] == [ 8, 9 ] and chain[-2:] == [ 0, 1 ] and last_secs == 8
+        assert fs.read_file('BIG')['data'][:cluster_size * 146 - 256] == data[:cluster_size * 146 - 256]
+        assert fs.get_number_of_free_clusters() == 0 and fs.find_empty_cluster() == -1
+
+    def test_directory_cache(self):
+        new_image = create_new_image()
+        disk = new_image.images[0]
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(disk)
+        for idx in range(10):
+            fs.write_file(f'FILE{idx}', bytearray([idx]) * 256 * 3, 2, 0, 0)
+        fs.get_valid_directory_entries()
+        dir_entries = fs.dir_entries
+        assert fs.get_directory_entry('FILE5')['dir_idx'] == 5 and fs.get_directory_entry_idx('FILE9') == 9
+        assert fs.read_file('FILE7')['data'][:256 * 3] == bytearray([7]) * 256 * 3
+        fs.write_file('NEWFILE', bytearray(256), 2, 0, 0)               # The cache is updated, not decoded again
+        fs.delete_file('FILE3')
+        assert fs.dir_entries is dir_entries
+        assert fs.is_exist('NEWFILE') and not fs.is_exist('FILE3') and fs.get_directory_entry_idx('FILE3') == -1
+        assert fs.get_directory_entry('NEWFILE')['num_sectors'] == 2
+        entry = fs.get_directory_entry('FILE1')
+        entry['file_name'] = b'BROKEN  '                                # Returned entries are copies
+        assert fs.is_exist('FILE1')
+
+        other_fs = fdimagelib.FM_FILE_SYSTEM()                          # Direct writes to the directory tracks invalidate the cache
+        other_fs.set_image(disk)
+        other_fs.delete_file('FILE1')
+        assert not fs.is_exist('FILE1') and fs.dir_entries is not dir_entries
+        disk.begin()
+        fs.delete_file('FILE2')
+        disk.rollback()
+        assert fs.is_exist('FILE2')
+        sect_data = bytearray(disk.read_sector_LBA(35)['sect_data'])
+        sect_data[0:8] = b'RENAMED '
+        disk.write_sector_LBA(35, sect_data)
+        assert fs.is_exist('RENAMED') and not fs.is_exist('FILE0')
+        assert [ entry['dir_idx'] for entry in fs.get_valid_directory_entries() ] == [ entry['dir_idx'] for entry in other_fs.get_valid_directory_entries() ]
+
+    def test_lazy_directory_entry(self):
+        new_image = create_new_image()
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(new_image.images[0])
+        for idx, file_name in enumerate([ 'ASM09', 'DEBUG', 'DISASM' ]):
+            fs.write_file(file_name, bytearray([idx + 1]) * (256 * (idx * 9 + 3) - 20), 2, 0, 0)
+        new_image.write_file('lazy_entry_test.d88')
+        image_file = fdimagelib.FLOPPY_IMAGE_D88()
+        image_file.read_file('lazy_entry_test.d88')
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(image_file.images[0])
+        eager_entries = [ (entry['dir_idx'], entry['num_sectors']) for entry in fs.get_all_directory_entries() ]
+
+        fs.set_image(image_file.images[0])
+        traced = []
+        trace_FAT_chain = fs.trace_FAT_chain
+        fs.trace_FAT_chain = lambda cluster: traced.append(cluster) or trace_FAT_chain(cluster)
+        entries = fs.get_valid_directory_entries()
+        assert fs.is_exist('ASM09') and fs.get_directory_entry('ASM09')['dir_idx'] >= 0
+        assert len(traced) == 0                                         # Listing and name lookups don't trace the FAT chains
+        entry = fs.get_directory_entry('ASM09')
+        num_sectors = entry['num_sectors']
+        assert entry['num_sectors'] == num_sectors and len(traced) == 1  # Memoized
+        assert fs.read_file('ASM09')['num_sectors'] == num_sectors
+        assert { entry['dir_idx']:entry['num_sectors'] for entry in entries }.items() <= dict(eager_entries).items()
+        assert [ entry['num_sectors'] for entry in entries ] == [ 3, 12, 21 ]
+
+        entry = pickle.loads(pickle.dumps(entries[0]))                  # Sent to other processes with the resolved values
+        assert entry.to_dict() == entries[0].to_dict()
+        fs.set_image(create_new_image().images[0])                      # Entries resolve on their own disk image after the file system is switched
+        assert entries[-1]['num_sectors'] == dict(eager_entries)[entries[-1]['dir_idx']]
+
+    def test_extract_all(self):
+        new_image = create_new_image()
+        fs = fdimagelib.FM_FILE_SYSTEM()
+        fs.set_image(new_image.images[0])
+        machine_code = lambda code: bytearray(struct.pack('>BHH', 0x00, len(code), 0x1000) + code + struct.pack('>BHHB', 0xff, 0, 0x1000, 0x1a))
+        for idx in range(6):
+            fs.write_file(f'FILE{idx}', machine_code(bytes([idx]) * (256 * (idx * 5 + 1) - 11)), 2, 0, 0)
+        fs.write_file('OTHER', bytearray(b'10 END\r\n\x1a'), 0, 0xff, 0)
+        fs.delete_file('FILE2')
+        fs.write_file('LAST', machine_code(bytes([0x55]) * (256 * 12 - 11)), 2, 0, 0)   # Placed in the hole of FILE2
+
+        files = fs.extract_all()
+        assert [ data['file_name_j'].rstrip() for data in files ] == [ 'FILE0', 'FILE1', 'LAST', 'FILE3', 'FILE4', 'FILE5', 'OTHER' ]
+        for data in files:
+            assert data == fs.read_file(data['file_name'])
+        assert [ data['file_name_j'].rstrip() for data in fs.extract_all('file?') ] == [ 'FILE0', 'FILE1', 'FILE3', 'FILE4', 'FILE5' ]
+        assert fs.extract_all('NONE*') == []
+
+        for dir_idx, file_name in [ (1, b'FILE0   '), (3, b'A/B     ') ]:       # Broken directory entries
+            data = bytearray(fs.read_directry_by_dir_idx(dir_idx)['sect_data'])
+            data[(dir_idx % 8) * 32 : (dir_idx % 8) * 32 + 8] = file_name
+            fs.write_directry_by_dir_idx(dir_idx, data)
+        new_image.write_file('extract_all_test.d88')
+        shutil.rmtree('extract_all_test', ignore_errors=True)
+        subprocess.run('python fmread.py -f extract_all_test.d88 --all -d extract_all_test -w 8', shell=True, check=True)
+        output_files = os.listdir('extract_all_test')
+        assert len(output_files) == 7 and 'FILE0   .2BS' in output_files and 'A_B     .2BS' in output_files
+        assert os.path.getsize('extract_all_test/FILE0   _1.2BS') == 256 * 6 - 11
+        subprocess.run('python fmread.py -f extract_all_test.d88 -s FILE4 -d extract_single', shell=True, check=True)
+        with open('extract_all_test/FILE4   .2BS', 'rb') as f, open('extract_single.2BS', 'rb') as f_single:
+            assert f.read() == f_single.read()
+        shutil.rmtree('extract_all_test', ignore_errors=True)
+        subprocess.run('python fmread.py -f extract_all_test.d88 -a "file?" -d extract_all_test', shell=True, check=True)
+        assert sorted(os.listdir('extract_all_test')) == [ 'FILE0   .2BS', 'FILE0   _1.2BS', 'FILE4   .2BS', 'FILE5   .2BS' ]
+
     def test_cmd_fmdir(self):
         subprocess.run(f'python fmdir.py -f {TestDiskImage.test_image_file} -n 0 -v --original', shell=True, check=True)
 
@@ -206,6 +1010,41 @@ class TestDiskImage(unittest.TestCase):
         for file_name, output in zip(file_names, output_names):
             subprocess.run(f'python fmread.py -f {TestDiskImage.test_image_file} -s {file_name} -d {output} -v', shell=True, check=True)
 
+    def test_cmd_fmindex(self):
+        test_dir = 'index_test'
+        test_db = 'index_test.db'
+        shutil.rmtree(test_dir, ignore_errors=True)
+        if os.path.exists(test_db):
+            os.remove(test_db)
+        os.mkdir(test_dir)
+        for num in range(2):
+            new_image = create_new_image()
+            fs = fdimagelib.FM_FILE_SYSTEM()
+            fs.set_image(new_image.images[0])
+            fs.write_file(f'IDX{num}', bytearray([num for _ in range(256 * 3)]), 2, 0, 0)
+            new_image.write_file(os.path.join(test_dir, f'index{num}.d88'))
+        res = subprocess.run(f'python fmindex.py -d {test_db} -s {test_dir} -v', shell=True, check=True, capture_output=True, text=True)
+        assert '2 indexed, 0 skipped' in res.stdout
+        res = subprocess.run(f'python fmindex.py -d {test_db} -s {test_dir} -v -q "idx*"', shell=True, check=True, capture_output=True, text=True)
+        assert '0 indexed, 2 skipped' in res.stdout
+        assert 'IDX0' in res.stdout and 'IDX1' in res.stdout
+
+        os.remove(os.path.join(test_dir, 'index1.d88'))
+        res = subprocess.run(f'python fmindex.py -d {test_db} -s {test_dir} -v -w 2 -q "IDX?"', shell=True, check=True, capture_output=True, text=True)
+        assert '0 indexed, 1 skipped, 1 removed' in res.stdout
+        assert 'IDX0' in res.stdout and 'IDX1' not in res.stdout
+
+        with open(os.path.join(test_dir, 'broken.d88'), 'wb') as f:
+            f.write(bytes(10))
+        for _ in range(2):                                              # A broken file is not recorded, and it is tried again
+            res = subprocess.run(f'python fmindex.py -d {test_db} -s {test_dir} -v', shell=True, check=True, capture_output=True, text=True)
+            assert 'Failed to index' in res.stdout and '1 indexed, 1 skipped' in res.stdout
+        with open(os.path.join(test_dir, 'index0.d88'), 'rb') as f:
+            image_hash = hashlib.sha1(f.read()).hexdigest()
+        db = sqlite3.connect(test_db)
+        assert db.execute('SELECT hash FROM files').fetchall() == [ (image_hash,) ]   # Hash of the indexed contents. No row for the broken file.
+        db.close()
+
     def test_cmd_fmmakefile(self):
         test_create_file = 'create_test.d88'
         if os.path.exists(test_create_file):
@@ -230,8 +1069,33 @@ test_set = [
     'test_serialize_deserialize',
     'test_read_file_by_idx',
     'test_get_directory_entries',
+    'test_zero_copy_load',
+    'test_lazy_load',
+    'test_sector_object',
+    'test_sector_index',
+    'test_incremental_write',
+    'test_streaming_write',
+    'test_image_index',
+    'test_parallel_parse',
+    'test_serialize_round_trip',
+    'test_layout_cache',
+    'test_sector_range_read',
+    'test_as_array',
+    'test_image_diff',
+    'test_transaction',
+    'test_crash_safe_write',
+    'test_compressed_source',
+    'test_flat_image',
+    'test_batch_sector_write',
+    'test_track_cache_budget',
+    'test_FAT_cache',
+    'test_cluster_allocator',
+    'test_directory_cache',
+    'test_lazy_directory_entry',
+    'test_extract_all',
     'test_cmd_fmdir',
     'test_cmd_fmread',
+    'test_cmd_fmindex',
     'test_cmd_fmmakefile',
 ]
 match 0: